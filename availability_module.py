@@ -0,0 +1,215 @@
+import numpy as np
+from datetime import date, datetime, time, timedelta
+from functools import lru_cache
+from storage_module import split_list
+
+WEEKDAY_NAMES = ['一', '二', '三', '四', '五', '六', '日']
+RULE_CACHE_SIZE = 20000  # 解析結果與展開視窗的快取筆數
+
+# available_dates 儲存格的規則格式（逗號分隔；舊資料的單一日期照常有效）：
+#   2026-10-20                 單一日期
+#   2026-10-01~2026-10-31      日期區間（含頭尾）
+#   W135                       每週一、三、五（1 = 週一 … 7 = 週日）
+#   W67@2026-10-01~2026-12-31  限定期間的每週規則，任一端可留空
+#   !2026-10-22、!A~B          排除的日期或區間，優先於上述規則
+
+
+def parse_day(text):
+    try:
+        return date.fromisoformat(text) if text else None
+    except ValueError:
+        return None
+
+def parse_span(text):
+    first, _, last = text.partition("~")
+    return parse_day(first.strip()), parse_day(last.strip())
+
+def span_token(start, end):
+    return f"{start.isoformat() if start else ''}~{end.isoformat() if end else ''}"
+
+
+class AvailabilityRules:
+    def __init__(self, tokens):
+        self.dates = set()
+        self.ranges = []
+        self.weekly = []  # (星期集合 0 = 週一, 起, 迄)
+        self.excluded_dates = set()
+        self.excluded_ranges = []
+        for token in tokens:
+            self.add_token(token)
+
+    # 無法解析的片段直接略過，不影響其他規則
+    def add_token(self, token):
+        token = token.strip()
+        if token.startswith("!"):
+            body = token[1:]
+            if "~" in body:
+                start, end = parse_span(body)
+                if start and end:
+                    self.excluded_ranges.append((start, end))
+            elif parse_day(body):
+                self.excluded_dates.add(parse_day(body))
+        elif token.startswith("W"):
+            days, _, span = token[1:].partition("@")
+            weekdays = frozenset(int(c) - 1 for c in days if c in "1234567")
+            if weekdays:
+                start, end = parse_span(span) if span else (None, None)
+                self.weekly.append((weekdays, start, end))
+        elif "~" in token:
+            start, end = parse_span(token)
+            if start and end and start <= end:
+                self.ranges.append((start, end))
+        elif parse_day(token):
+            self.dates.add(parse_day(token))
+
+    def is_plain(self):
+        return not (self.ranges or self.weekly or self.excluded_dates or self.excluded_ranges)
+
+    # [start, start+days) 的空閒遮罩；每條規則只做一次陣列運算，成本與規劃多遠無關
+    def mask(self, start, days):
+        bits = np.zeros(days, dtype=bool)
+
+        # 夾在 [0, days] 內；整段落在視窗外時 lo >= hi，切片為空
+        def clip(first, last):
+            lo = 0 if first is None else min(max((first - start).days, 0), days)
+            hi = days if last is None else min(max((last - start).days + 1, 0), days)
+            return lo, hi
+
+        for d in self.dates:
+            offset = (d - start).days
+            if 0 <= offset < days:
+                bits[offset] = True
+        for first, last in self.ranges:
+            lo, hi = clip(first, last)
+            bits[lo:hi] = True
+        if self.weekly:
+            weekday = (start.weekday() + np.arange(days)) % 7
+            for weekdays, first, last in self.weekly:
+                lo, hi = clip(first, last)
+                if lo < hi:
+                    bits[lo:hi] |= np.isin(weekday[lo:hi], list(weekdays))
+        for d in self.excluded_dates:
+            offset = (d - start).days
+            if 0 <= offset < days:
+                bits[offset] = False
+        for first, last in self.excluded_ranges:
+            lo, hi = clip(first, last)
+            bits[lo:hi] = False
+        return bits
+
+    def is_excluded(self, d):
+        return d in self.excluded_dates or any(first <= d <= last for first, last in self.excluded_ranges)
+
+    # 重新組成儲存格內容；since 之前已結束的規則一併清掉，儲存格不會無限增長
+    def to_tokens(self, since=None):
+        keep = lambda last: since is None or last is None or last >= since
+        tokens = [d.isoformat() for d in sorted(self.dates) if keep(d)]
+        tokens += [span_token(first, last) for first, last in sorted(self.ranges) if keep(last)]
+        for weekdays, first, last in self.weekly:
+            if keep(last):
+                days = "".join(str(w + 1) for w in sorted(weekdays))
+                tokens.append(f"W{days}@{span_token(first, last)}" if first or last else f"W{days}")
+        tokens += [f"!{d.isoformat()}" for d in sorted(self.excluded_dates) if keep(d)]
+        tokens += [f"!{span_token(first, last)}" for first, last in sorted(self.excluded_ranges) if keep(last)]
+        return tokens
+
+    # 給人看的摘要
+    def describe(self):
+        lines = []
+        if self.dates:
+            lines.append("、".join(d.isoformat() for d in sorted(self.dates)))
+        for first, last in sorted(self.ranges):
+            lines.append(f"{first.isoformat()} ～ {last.isoformat()}")
+        for weekdays, first, last in self.weekly:
+            text = "每週" + "、".join(WEEKDAY_NAMES[w] for w in sorted(weekdays))
+            if first or last:
+                text += f"（{first.isoformat() if first else ''} ～ {last.isoformat() if last else ''}）"
+            lines.append(text)
+        excluded = [d.isoformat() for d in sorted(self.excluded_dates)]
+        excluded += [f"{first.isoformat()} ～ {last.isoformat()}" for first, last in sorted(self.excluded_ranges)]
+        if excluded:
+            lines.append("除了 " + "、".join(excluded))
+        return lines
+
+
+@lru_cache(maxsize=RULE_CACHE_SIZE)
+def rules_from_tokens(tokens):
+    return AvailabilityRules(tokens)
+
+def parse_rules(raw):
+    return rules_from_tokens(tuple(split_list(raw)))
+
+# 只展開查詢的視窗，結果依 (原始字串, 起日, 天數) 快取
+@lru_cache(maxsize=RULE_CACHE_SIZE)
+def expand_window(raw, start, days):
+    bits = parse_rules(raw).mask(start, days)
+    return frozenset((start + timedelta(days=int(i))).isoformat() for i in np.flatnonzero(bits))
+
+# 由表單欄位組成規則片段；weekly 為 (星期集合, 起, 迄) 的清單
+def build_rule_tokens(dates=(), ranges=(), weekly=(), excluded=(), excluded_ranges=(), since=None):
+    rules = AvailabilityRules([])
+    rules.dates = set(dates)
+    rules.ranges = [(first, last) for first, last in ranges if first and last and first <= last]
+    rules.weekly = [(frozenset(weekdays), first, last) for weekdays, first, last in weekly if weekdays]
+    rules.excluded_dates = set(excluded)
+    rules.excluded_ranges = list(excluded_ranges)
+    return rules.to_tokens(since)
+
+
+# available_slots 儲存格的時段格式（逗號分隔）：
+#   2026-10-20 19:00-21:00   單日時段
+#   W2 19:00-21:00           每週二的固定時段（1 = 週一 … 7 = 週日）
+# 結束時間不晚於開始時間表示跨過午夜
+
+def parse_clock(text):
+    hours, _, minutes = text.strip().partition(":")
+    if not (hours.isdigit() and minutes.isdigit()) or int(hours) > 24 or int(minutes) > 59:
+        return None
+    return int(hours) * 60 + int(minutes)
+
+def format_clock(minutes):
+    return f"{minutes // 60:02d}:{minutes % 60:02d}"
+
+# 每個時段為 (日期或 None, 星期或 None, 開始分鐘, 結束分鐘)
+@lru_cache(maxsize=RULE_CACHE_SIZE)
+def slots_from_tokens(tokens):
+    slots = []
+    for token in tokens:
+        when, _, span = token.strip().partition(" ")
+        first, _, last = span.partition("-")
+        start, end = parse_clock(first), parse_clock(last)
+        if start is None or end is None:
+            continue
+        if end <= start:
+            end += 24 * 60
+        if when.startswith("W") and len(when) == 2 and when[1] in "1234567":
+            slots.append((None, int(when[1]) - 1, start, end))
+        elif parse_day(when):
+            slots.append((parse_day(when), None, start, end))
+    return tuple(slots)
+
+def parse_slots(raw):
+    return slots_from_tokens(tuple(split_list(raw)))
+
+def slot_token(day, weekday, start, end):
+    when = f"W{weekday + 1}" if day is None else day.isoformat()
+    return f"{when} {format_clock(start)}-{format_clock(end % (24 * 60))}"
+
+def describe_slot(day, weekday, start, end):
+    when = f"每週{WEEKDAY_NAMES[weekday]}" if day is None else day.isoformat()
+    return f"{when} {format_clock(start)}–{format_clock(end % (24 * 60))}"
+
+# 展開成 [start, start+days) 內的 (開始, 結束) datetime 區間
+@lru_cache(maxsize=RULE_CACHE_SIZE)
+def expand_slot_tokens(tokens, start, days):
+    intervals = []
+    base = datetime.combine(start, time())
+    for day, weekday, first, last in slots_from_tokens(tokens):
+        if day is not None:
+            offsets = [(day - start).days] if 0 <= (day - start).days < days else []
+        else:
+            offsets = range((weekday - start.weekday()) % 7, days, 7)
+        for offset in offsets:
+            day_start = base + timedelta(days=offset)
+            intervals.append((day_start + timedelta(minutes=first), day_start + timedelta(minutes=last)))
+    return tuple(sorted(intervals))
@@ -0,0 +1,196 @@
+import os
+os.environ.setdefault("NOJO_STORAGE", "memory")  # 一律離線，使用記憶體內的假試算表
+
+import argparse
+import json
+import platform
+import random
+import statistics
+import time
+import pandas as pd
+from datetime import date, datetime, timedelta
+
+import storage_module
+import main
+import index_module
+from storage_module import DatasetStore, TABLES, DEFAULT_COLUMNS, EVENT_COLUMNS, create_backends, serialize_frame, join_list
+
+# 完整規模；--scales 以比例縮放
+FULL_SIZE = {"users": 10000, "friendships": 200000, "groups": 2000, "events": 50000}
+DEFAULT_SCALES = [0.01, 0.1, 1.0]
+DEFAULT_REPEAT = 20
+AVAILABLE_DAYS = 60  # 空閒日期分布在今天起的天數內
+DATES_PER_USER = 10
+MEMBERS_PER_GROUP = 8
+
+
+def user_name(i):
+    return f"user{i:06d}"
+
+# 產生與 get_df() 相同欄位格式的使用者資料表與活動資料表
+def generate_dataset(users, friendships, groups, events, seed=0):
+    rng = random.Random(seed)
+    today = date.today()
+    user_ids = [user_name(i) for i in range(users)]
+
+    friends = {u: set() for u in user_ids}
+    requests = {u: set() for u in user_ids}
+    edges = 0
+    target = min(friendships, users * (users - 1) // 2)
+    while edges < target:
+        a, b = rng.sample(user_ids, 2)
+        if b not in friends[a]:
+            friends[a].add(b)
+            friends[b].add(a)
+            edges += 1
+    for u in user_ids:
+        if rng.random() < 0.1:
+            requester = rng.choice(user_ids)
+            if requester != u and requester not in friends[u]:
+                requests[u].add(requester)
+
+    group_names = [f"group{i:05d}" for i in range(groups)]
+    memberships = {u: set() for u in user_ids}
+    for g in group_names:
+        for member in rng.sample(user_ids, min(MEMBERS_PER_GROUP, users)):
+            memberships[member].add(g)
+
+    rows = []
+    for u in user_ids:
+        dates = {(today + timedelta(days=rng.randrange(AVAILABLE_DAYS))).strftime("%Y-%m-%d") for _ in range(DATES_PER_USER)}
+        rows.append({
+            "user_id": u,
+            "password": "pass1234",
+            "available_dates": ",".join(sorted(dates)),
+            "friends": join_list(friends[u]),
+            "friend_requests": join_list(requests[u]),
+            "groups": join_list(memberships[u]),
+            "group_members": "".join(f"|{g}:{u}" for g in sorted(memberships[u])),
+        })
+    records = pd.DataFrame(rows).reindex(columns=DEFAULT_COLUMNS).fillna("")
+
+    event_rows = []
+    for i in range(events):
+        yes = rng.sample(user_ids, min(3, users))
+        event_rows.append({
+            "activity_id": f"act{i:07d}",
+            "group_name": rng.choice(group_names) if group_names else "",
+            "event_title": f"活動 {i}",
+            "event_date": (today + timedelta(days=rng.randrange(-30, AVAILABLE_DAYS))).strftime("%Y-%m-%d"),
+            "created_by": yes[0],
+            "event_summary": "",
+            "participants_yes": join_list(yes),
+            "participants_no": "",
+            "yes_count": len(yes),
+            "no_count": 0,
+        })
+    events_df = pd.DataFrame(event_rows).reindex(columns=EVENT_COLUMNS).fillna("")
+    return records, events_df
+
+# 換上全新的記憶體後端並寫入資料；寫入佇列共用同一個 dict，不需重建
+def load_dataset(records, events):
+    backends = create_backends("memory")
+    storage_module._stores.update({table: DatasetStore(backend, TABLES[table]["columns"]) for table, backend in backends.items()})
+    storage_module.save_df(records, table="records")
+    storage_module.save_df(events, table="events")
+
+
+def measure(fn, args_list):
+    timings = []
+    for args in args_list:
+        start = time.perf_counter()
+        fn(*args)
+        timings.append(time.perf_counter() - start)
+    return {
+        "repeat": len(timings),
+        "first_ms": round(timings[0] * 1000, 3),
+        "median_ms": round(statistics.median(timings) * 1000, 3),
+        "min_ms": round(min(timings) * 1000, 3),
+        "max_ms": round(max(timings) * 1000, 3),
+    }
+
+# 每個函式在 repeat 組不同參數下的耗時；第一次呼叫包含索引建立（冷啟動）
+def run_scale(scale, repeat, seed):
+    size = {name: max(1, int(n * scale)) for name, n in FULL_SIZE.items()}
+    started = time.perf_counter()
+    records, events = generate_dataset(seed=seed, **size)
+    generate_s = time.perf_counter() - started
+    started = time.perf_counter()
+    load_dataset(records, events)
+    load_s = time.perf_counter() - started
+
+    rng = random.Random(seed + 1)
+    user_ids = records["user_id"].tolist()
+    group_names = sorted({g for gs in records["groups"] for g in gs.split(",") if g})
+    activity_ids = events["activity_id"].tolist()
+    today = date.today()
+    pick_users = lambda: rng.sample(user_ids, min(repeat, len(user_ids)))
+
+    # 送出申請給非好友，再由對方接受
+    pairs = []
+    for a in pick_users():
+        b = rng.choice(user_ids)
+        if a != b and b not in records.at[user_ids.index(a), "friends"].split(","):
+            pairs.append((a, b))
+
+    # 寫回前的序列化：一欄混入 datetime 物件需要轉換，其餘欄位與快照相同
+    snapshot = storage_module.get_store().df
+    mixed = snapshot.copy()
+    mixed["available_dates"] = mixed["available_dates"].astype(object)
+    mixed.loc[mixed.index[::10], "available_dates"] = datetime.now()
+
+    cases = {
+        "find_users_by_date": (main.find_users_by_date, [((today + timedelta(days=i % AVAILABLE_DAYS)).strftime("%Y-%m-%d"), u) for i, u in enumerate(pick_users())]),
+        "list_groups_for_user": (main.list_groups_for_user, [(u,) for u in pick_users()]),
+        # 配對索引改由背景建立：先量一次建立的耗時，再量讀取端
+        "warm_indexes": (index_module.warm_indexes, [()]),
+        "top_matches": (main.top_matches, [(u,) for u in pick_users()]),
+        "update_availability": (main.update_availability, [(u, [(today + timedelta(days=rng.randrange(AVAILABLE_DAYS))).strftime("%Y-%m-%d")]) for u in pick_users()]),
+        "get_event_rows": (main.get_event_rows, [(g,) for g in rng.sample(group_names, min(repeat, len(group_names)))]),
+        "rsvp_event": (main.rsvp_event, [(e, u, "yes") for e, u in zip(rng.sample(activity_ids, min(repeat, len(activity_ids))), pick_users())]),
+        "send_friend_request": (main.send_friend_request, pairs),
+        "accept_friend_request": (main.accept_friend_request, [(b, a) for a, b in pairs]),
+        "serialize_frame": (serialize_frame, [(mixed, snapshot)] * max(1, repeat // 4)),
+        "delete_group": (main.delete_group, [(g,) for g in rng.sample(group_names, min(repeat, len(group_names)))]),
+    }
+    results = []
+    for name, (fn, args_list) in cases.items():
+        if not args_list:
+            continue
+        results.append({"scale": scale, **size, "function": name, **measure(fn, args_list)})
+    return {"scale": scale, **size, "generate_s": round(generate_s, 3), "load_s": round(load_s, 3)}, results
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="NO_JO 資料函式的合成資料基準測試（離線）")
+    parser.add_argument("--scales", default=",".join(str(s) for s in DEFAULT_SCALES), help="相對於完整規模的比例，以逗號分隔")
+    parser.add_argument("--repeat", type=int, default=DEFAULT_REPEAT)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="bench_results.json")
+    parser.add_argument("--coalesce-window", type=float, default=0.0, help="寫入佇列的合併等待秒數；預設 0 只量測處理本身")
+    args = parser.parse_args()
+    storage_module._mutations.window = args.coalesce_window
+
+    datasets, results = [], []
+    for scale in [float(s) for s in args.scales.split(",")]:
+        dataset, rows = run_scale(scale, args.repeat, args.seed)
+        datasets.append(dataset)
+        results.extend(rows)
+        for row in rows:
+            print(f"{scale:>6} {row['function']:<24} median {row['median_ms']:>10.3f} ms  first {row['first_ms']:>10.3f} ms")
+
+    report = {
+        "generated_at": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "pandas": pd.__version__,
+        "repeat": args.repeat,
+        "datasets": datasets,
+        "results": results,
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"已寫入 {args.output}")
+
+
+if __name__ == "__main__":
+    main_cli()
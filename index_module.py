@@ -0,0 +1,659 @@
+import heapq
+import logging
+import threading
+import numpy as np
+import pandas as pd
+from bisect import bisect_left, bisect_right, insort
+from collections import Counter, defaultdict
+from datetime import date, timedelta
+from storage_module import get_index, warm_index, peek_index, background
+from availability_module import rules_from_tokens, expand_slot_tokens
+
+try:
+    from scipy import sparse
+except ImportError:  # 沒有 scipy 時改用 numpy 的稠密矩陣乘法
+    sparse = None
+
+BITMAP_PAST_DAYS = 31  # 點陣圖涵蓋今天以前的天數
+BITMAP_DAYS = 400  # 點陣圖總寬度（天）
+NGRAM = 3  # 子字串索引的片段長度；較短的查詢改為掃描排序清單
+SLOT_DAYS = 56  # 時段索引展開的天數（從今天起）
+SLOT_PIECE = timedelta(hours=24)  # 時段索引中單一片段的最長長度
+MATCH_DAYS = 90  # 配對計算涵蓋的天數（從今天起）
+MATCH_TOP_K = 20  # 每位使用者預先保留的最佳配對數
+MATCH_CHUNK = 1024  # 全體配對時每批計算的使用者數，限制暫存矩陣大小
+
+
+# 日期 → 有空使用者集合的反向索引（由型別化檢視建立，日期已預先切好）
+# 每週／區間規則只在 [start, start+days) 視窗內展開；單一日期不受視窗限制
+# 另存每位使用者展開後的日期，寫入後只移除舊日期、加入新日期
+class AvailabilityIndex:
+    def __init__(self, df, start, days=BITMAP_DAYS):
+        self.start = start
+        self.end = start + timedelta(days=days)
+        self.days = days
+        self.labels = [(start + timedelta(days=i)).isoformat() for i in range(days)]
+        self.by_date = defaultdict(set)
+        self.dates_of = {}
+        for user_id, dates in zip(df['user_id'], df['available_dates']):
+            if user_id:
+                self.add_user(user_id, self.expand(dates))
+        self.sorted_dates = sorted(self.by_date)
+
+    def expand(self, dates):
+        rules = rules_from_tokens(tuple(dates))
+        if rules.is_plain():
+            return set(dates)
+        days = {self.labels[i] for i in np.flatnonzero(rules.mask(self.start, self.days))}
+        days.update(d.isoformat() for d in rules.dates if not self.start <= d < self.end and not rules.is_excluded(d))
+        return days
+
+    def add_user(self, user_id, days):
+        self.dates_of.setdefault(user_id, set()).update(days)
+        for d in days:
+            self.by_date[d].add(user_id)
+
+    def update_rows(self, old_rows, new_rows):
+        for user_id in old_rows['user_id']:
+            for d in self.dates_of.pop(user_id, ()):
+                self.by_date[d].discard(user_id)
+                if not self.by_date[d]:
+                    del self.by_date[d]
+                    del self.sorted_dates[bisect_left(self.sorted_dates, d)]
+        for user_id, dates in zip(new_rows['user_id'], new_rows['available_dates']):
+            if not user_id:
+                continue
+            days = self.expand(dates)
+            for d in days:
+                if d not in self.by_date:
+                    insort(self.sorted_dates, d)
+            self.add_user(user_id, days)
+
+    def users_on(self, date_str):
+        return self.by_date.get(date_str, set())
+
+    # 所有日期都有空：由最小的集合開始取交集
+    def users_on_all(self, date_strs):
+        sets = sorted((self.users_on(d) for d in date_strs), key=len)
+        if not sets:
+            return set()
+        result = set(sets[0])
+        for s in sets[1:]:
+            result &= s
+            if not result:
+                break
+        return result
+
+    def users_on_any(self, date_strs):
+        result = set()
+        for d in date_strs:
+            result |= self.users_on(d)
+        return result
+
+    # 區間內任一天有空（日期字串為 YYYY-MM-DD，可直接依字典序比較）
+    def users_in_range(self, start_str, end_str):
+        lo = bisect_left(self.sorted_dates, start_str)
+        hi = bisect_right(self.sorted_dates, end_str)
+        return self.users_on_any(self.sorted_dates[lo:hi])
+
+
+# 使用者 × 日期的空閒點陣圖（bool 矩陣），固定寬度，從 start 起算；由型別化檢視建立
+class AvailabilityMatrix:
+    def __init__(self, df, start, days=BITMAP_DAYS):
+        users = df[df['user_id'].astype(str) != ''].drop_duplicates('user_id').reset_index(drop=True)
+        self.user_ids = users['user_id'].astype(str).tolist()
+        self.user_pos = {u: i for i, u in enumerate(self.user_ids)}
+        self.start = start
+        self.days = days
+        self.bits = np.zeros((len(self.user_ids), days), dtype=bool)
+        exploded = users['available_dates'].explode()
+        parsed = pd.to_datetime(exploded, format="%Y-%m-%d", errors="coerce")
+        offsets = (parsed - pd.Timestamp(start)).dt.days
+        valid = offsets.notna() & (offsets >= 0) & (offsets < days)
+        self.bits[exploded.index[valid].to_numpy(), offsets[valid].astype(int).to_numpy()] = True
+        # 含規則（非單一日期）的使用者逐一展開整列，排除日也在這裡套用
+        has_rule = parsed.isna() & exploded.notna()
+        for pos in np.unique(exploded.index[has_rule.to_numpy()]):
+            self.bits[pos] = rules_from_tokens(tuple(users.at[pos, 'available_dates'])).mask(start, days)
+
+    # 寫入後只重新展開變動的使用者；刪除的使用者整列清空，新使用者先加長陣列再登記位置，
+    # 同時查詢的讀取端不會拿到超出陣列的位置
+    def update_rows(self, old_rows, new_rows):
+        changed = {u: [] for u in old_rows['user_id'] if u}
+        changed.update({u: tokens for u, tokens in zip(new_rows['user_id'], new_rows['available_dates']) if u})
+        for user_id, tokens in changed.items():
+            bits = rules_from_tokens(tuple(tokens)).mask(self.start, self.days)
+            pos = self.user_pos.get(user_id)
+            if pos is None:
+                if not bits.any():
+                    continue
+                self.bits = np.vstack([self.bits, bits[None, :]])
+                self.user_ids.append(user_id)
+                self.user_pos[user_id] = len(self.user_ids) - 1
+            else:
+                self.bits[pos] = bits
+
+    def offset(self, day):
+        return min(max((day - self.start).days, 0), self.days)
+
+    def date_labels(self, first, count):
+        return [(first + timedelta(days=i)).strftime("%Y-%m-%d") for i in range(count)]
+
+    # 取出指定成員在 [first, first+count) 的子矩陣，查無資料的成員為全 False
+    def rows(self, user_ids, first, count):
+        lo = self.offset(first)
+        hi = self.offset(first + timedelta(days=count))
+        sub = np.zeros((len(user_ids), count), dtype=bool)
+        pos = [self.user_pos.get(u) for u in user_ids]
+        found = [i for i, p in enumerate(pos) if p is not None]
+        if found and hi > lo:
+            start_col = lo - (first - self.start).days
+            sub[found, start_col:start_col + hi - lo] = self.bits[[pos[i] for i in found], lo:hi]
+        return sub
+
+    def group_overlap(self, user_ids, first, count):
+        return self.rows(user_ids, first, count).sum(axis=0)
+
+    # 有空人數最多的前 k 天（同數量時較早的日期優先）
+    def top_dates(self, user_ids, first, count, k=5):
+        counts = self.group_overlap(user_ids, first, count)
+        order = np.argsort(-counts, kind="stable")[:k]
+        labels = self.date_labels(first, count)
+        return [(labels[i], int(counts[i])) for i in order if counts[i] > 0]
+
+
+# 所有使用者兩兩之間的空閒重疊（Jaccard：共同天數 / 聯集天數），預先保留每人前 k 名
+# 建立時以 使用者 × 天數 的關聯矩陣做 A·Aᵀ（分批，避免 n × n 的暫存）；
+# 單一使用者的空閒改變時只算一次 A·a，再修補受影響的排行，被擠出名單的列等到查詢時才重算
+class MatchIndex:
+    def __init__(self, df, start, days=MATCH_DAYS, k=MATCH_TOP_K):
+        matrix = AvailabilityMatrix(df, start, days)
+        self.start = start
+        self.days = days
+        self.k = k
+        self.user_ids = list(matrix.user_ids)
+        self.user_pos = dict(matrix.user_pos)
+        self.bits = matrix.bits.astype(np.float32)
+        self.sizes = self.bits.sum(axis=1)
+        n = len(self.user_ids)
+        self.top_pos = np.full((n, k), -1, dtype=np.int64)
+        self.top_score = np.zeros((n, k), dtype=np.float32)
+        self.dirty = set()
+        # 寫入者套用差異與讀取端重算待更新的列都會改動共用的陣列，一律持有同一把鎖
+        self.lock = threading.Lock()
+        incidence = sparse.csr_matrix(self.bits) if sparse is not None else self.bits
+        for lo in range(0, n, MATCH_CHUNK):
+            hi = min(lo + MATCH_CHUNK, n)
+            overlap = incidence[lo:hi] @ incidence.T
+            overlap = overlap.toarray() if sparse is not None else overlap
+            self.store_top(np.arange(lo, hi), self.jaccard(overlap, self.sizes[lo:hi, None]))
+
+    def jaccard(self, overlap, sizes):
+        union = sizes + self.sizes[None, :] - overlap
+        return np.divide(overlap, union, out=np.zeros_like(overlap, dtype=np.float32), where=union > 0)
+
+    # scores 為 rows × n 的分數矩陣；排除自己與零分後各取前 k 名
+    def store_top(self, rows, scores):
+        scores[np.arange(len(rows)), rows] = 0
+        self.top_pos[rows] = -1
+        self.top_score[rows] = 0
+        k = min(self.k, scores.shape[1])
+        if k == 0:
+            return
+        part = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        part_scores = np.take_along_axis(scores, part, axis=1)
+        order = np.argsort(-part_scores, axis=1, kind="stable")
+        top = np.take_along_axis(part, order, axis=1)
+        top_scores = np.take_along_axis(part_scores, order, axis=1)
+        self.top_pos[rows, :k] = np.where(top_scores > 0, top, -1)
+        self.top_score[rows, :k] = np.where(top_scores > 0, top_scores, 0)
+
+    def recompute(self, pos):
+        overlap = (self.bits @ self.bits[pos])[None, :]
+        self.store_top(np.array([pos]), self.jaccard(overlap, self.sizes[pos]))
+        self.dirty.discard(pos)
+
+    def add_user(self, user_id):
+        self.user_pos[user_id] = len(self.user_ids)
+        self.user_ids.append(user_id)
+        self.bits = np.vstack([self.bits, np.zeros((1, self.days), dtype=np.float32)])
+        self.sizes = np.append(self.sizes, np.float32(0))
+        self.top_pos = np.vstack([self.top_pos, np.full((1, self.k), -1, dtype=np.int64)])
+        self.top_score = np.vstack([self.top_score, np.zeros((1, self.k), dtype=np.float32)])
+        return self.user_pos[user_id]
+
+    # 寫入後只重算變動的使用者；刪除的使用者視為沒有空閒，自然從所有排行中消失
+    def update_rows(self, old_rows, new_rows):
+        changed = {u: [] for u in old_rows['user_id'] if u}
+        changed.update({u: raw for u, raw in zip(new_rows['user_id'], new_rows['available_dates']) if u})
+        masks = {u: rules_from_tokens(tuple(tokens)).mask(self.start, self.days).astype(np.float32) for u, tokens in changed.items()}
+        with self.lock:
+            for user_id, bits in masks.items():
+                pos = self.user_pos.get(user_id)
+                if pos is None:
+                    pos = self.add_user(user_id)
+                if np.array_equal(bits, self.bits[pos]):
+                    continue
+                self.bits[pos] = bits
+                self.sizes[pos] = bits.sum()
+                self.patch_user(pos)
+
+    def patch_user(self, pos):
+        scores = self.jaccard((self.bits @ self.bits[pos])[None, :], self.sizes[pos])[0]
+        scores[pos] = 0
+        self.store_top(np.array([pos]), scores[None, :].copy())
+        self.dirty.discard(pos)
+        # 原本就在名單中：分數不低於名單其他人的最低分時原地更新，否則整列待重算
+        listed = np.flatnonzero((self.top_pos == pos).any(axis=1))
+        for row in listed:
+            slot = np.flatnonzero(self.top_pos[row] == pos)[0]
+            others = np.delete(self.top_score[row], slot)
+            floor = others[self.top_pos[row][np.arange(self.k) != slot] >= 0].min(initial=np.inf)
+            if scores[row] > 0 and (scores[row] >= floor or (self.top_pos[row] < 0).any()):
+                self.top_score[row, slot] = scores[row]
+                self.resort(row)
+            else:
+                self.dirty.add(row)
+        # 不在名單中：分數勝過名單最後一名（或名單未滿）就取代它
+        floor = np.where(self.top_pos[:, -1] >= 0, self.top_score[:, -1], 0)
+        entering = np.flatnonzero((scores > floor) & (scores > 0))
+        entering = entering[~np.isin(entering, listed)]
+        entering = entering[entering != pos]
+        self.top_pos[entering, -1] = pos
+        self.top_score[entering, -1] = scores[entering]
+        for row in entering:
+            self.resort(row)
+
+    def resort(self, row):
+        order = np.argsort(-self.top_score[row], kind="stable")
+        self.top_pos[row] = self.top_pos[row][order]
+        self.top_score[row] = self.top_score[row][order]
+
+    # [(使用者, 分數, 共同天數)]，依分數由高到低
+    def top_matches(self, user_id, k=None):
+        with self.lock:
+            pos = self.user_pos.get(user_id)
+            if pos is None:
+                return []
+            if pos in self.dirty:
+                self.recompute(pos)
+            result = []
+            for other, score in zip(self.top_pos[pos][:k or self.k], self.top_score[pos]):
+                if other < 0:
+                    break
+                common = int(self.bits[pos] @ self.bits[other])
+                result.append((self.user_ids[other], float(score), common))
+            return result
+
+
+# 小時層級的空閒時段：合併後的區間切成不超過 SLOT_PIECE 的片段，依開始時間排序（sorted-endpoint），
+# 另存每位使用者合併後的區間。包含 start 的片段必定從 [start - SLOT_PIECE, start] 內開始，
+# 兩次二分搜尋即可框出候選，再以該使用者合併後的區間確認整段都有空，查詢為 O(log n + k)；
+# 連續多天（例如每天 00:00-00:00）合併成的長區間也不會讓每次查詢變成全表掃描
+class SlotIndex:
+    def __init__(self, df, start, days=SLOT_DAYS):
+        self.start = start
+        self.days = days
+        self.by_user = {}
+        entries = []
+        for user_id, slots in zip(df['user_id'], df['available_slots']):
+            merged = self.merge(slots) if user_id else []
+            if merged:
+                self.by_user[user_id] = merged
+                entries.extend((first, last, user_id) for first, last in pieces(merged))
+        entries.sort()
+        self.entries = entries
+        self.starts = [first for first, _, _ in entries]
+
+    # 展開後相接或重疊的區間合併成一段
+    def merge(self, slots):
+        merged = []
+        for first, last in expand_slot_tokens(tuple(slots), self.start, self.days):
+            if merged and first <= merged[-1][1]:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], last))
+            else:
+                merged.append((first, last))
+        return merged
+
+    # 寫入後只移除變動使用者的舊片段、插入新片段
+    def update_rows(self, old_rows, new_rows):
+        for user_id in old_rows['user_id']:
+            for first, last in pieces(self.by_user.pop(user_id, ())):
+                pos = bisect_left(self.entries, (first, last, user_id))
+                del self.entries[pos]
+                del self.starts[pos]
+        for user_id, slots in zip(new_rows['user_id'], new_rows['available_slots']):
+            merged = self.merge(slots) if user_id else []
+            if merged:
+                self.by_user[user_id] = merged
+            for first, last in pieces(merged):
+                pos = bisect_left(self.entries, (first, last, user_id))
+                self.entries.insert(pos, (first, last, user_id))
+                self.starts.insert(pos, first)
+
+    # 整段 [start, end) 都有空的使用者
+    def users_free(self, start, end):
+        lo = bisect_left(self.starts, start - SLOT_PIECE)
+        hi = bisect_right(self.starts, start)
+        candidates = {user_id for _, last, user_id in self.entries[lo:hi] if last >= start}
+        return {user_id for user_id in candidates if self.covers(user_id, start, end)}
+
+    # 使用者合併後的區間互不相接，開始不晚於 start 的最後一段就是唯一可能涵蓋 [start, end) 的區間
+    def covers(self, user_id, start, end):
+        merged = self.by_user.get(user_id, ())
+        i = bisect_left(merged, (start,))
+        if i < len(merged) and merged[i][0] == start:
+            i += 1
+        return i > 0 and merged[i - 1][1] >= end
+
+    # 掃描成員區間的端點，切成有空人數固定的連續片段 (開始, 結束, 人數)
+    def windows(self, user_ids, after=None):
+        points = []
+        for user_id in set(user_ids):
+            for first, last in self.by_user.get(user_id, ()):
+                if after is not None and last <= after:
+                    continue
+                points.append((max(first, after) if after else first, 1))
+                points.append((last, -1))
+        points.sort()
+        segments = []
+        active, prev = 0, None
+        for t, delta in points:
+            if prev is not None and t > prev and active:
+                if segments and segments[-1][1] == prev and segments[-1][2] == active:
+                    segments[-1] = (segments[-1][0], t, active)
+                else:
+                    segments.append((prev, t, active))
+            active += delta
+            prev = t
+        return segments
+
+    # 所有成員同時有空的最長片段；沒有則為 None
+    def longest_common_window(self, user_ids, after=None):
+        need = len(set(user_ids))
+        common = [seg for seg in self.windows(user_ids, after) if seg[2] == need]
+        return max(common, key=lambda seg: seg[1] - seg[0], default=None)
+
+    # 至少 duration 長、有空人數最多的片段（同人數取較早者）
+    def best_window(self, user_ids, duration, after=None):
+        candidates = [seg for seg in self.windows(user_ids, after) if seg[1] - seg[0] >= duration]
+        return max(candidates, key=lambda seg: (seg[2], -seg[0].timestamp()), default=None)
+
+
+# 合併後的區間切成不超過 SLOT_PIECE 的片段
+def pieces(merged):
+    for first, last in merged:
+        while last - first > SLOT_PIECE:
+            yield first, first + SLOT_PIECE
+            first += SLOT_PIECE
+        yield first, last
+
+
+# 使用者 → 列位置，寫入後只更新變動的列
+class UserRowIndex:
+    def __init__(self, df):
+        self.labels = {}
+        self.update_rows(df.iloc[0:0], df)
+
+    def update_rows(self, old_rows, new_rows):
+        for label, user_id in zip(old_rows.index, old_rows['user_id']):
+            if user_id and self.labels.get(user_id) == label:
+                del self.labels[user_id]
+        for label, user_id in zip(new_rows.index, new_rows['user_id']):
+            if user_id and user_id not in self.labels:
+                self.labels[user_id] = label
+
+
+# user_id 搜尋索引：排序清單做前綴查詢，三字元片段的反向索引做子字串查詢（不分大小寫）
+class UserSearchIndex:
+    def __init__(self, df):
+        self.keys = []
+        self.grams = defaultdict(set)
+        self.update_rows(df.iloc[0:0], df)
+
+    def update_rows(self, old_rows, new_rows):
+        for user_id in old_rows['user_id']:
+            key = (str(user_id).lower(), user_id)
+            pos = bisect_left(self.keys, key)
+            if user_id and pos < len(self.keys) and self.keys[pos] == key:
+                del self.keys[pos]
+                for gram in self.ngrams(key[0]):
+                    self.grams[gram].discard(user_id)
+        for user_id in new_rows['user_id']:
+            key = (str(user_id).lower(), user_id)
+            pos = bisect_left(self.keys, key)
+            if user_id and (pos == len(self.keys) or self.keys[pos] != key):
+                insort(self.keys, key)
+                for gram in self.ngrams(key[0]):
+                    self.grams[gram].add(user_id)
+
+    def ngrams(self, text):
+        return {text[i:i + NGRAM] for i in range(len(text) - NGRAM + 1)}
+
+    def prefix(self, query, limit):
+        start = bisect_left(self.keys, (query,))
+        result = []
+        for key, user_id in self.keys[start:]:
+            if not key.startswith(query) or len(result) >= limit:
+                break
+            result.append(user_id)
+        return result
+
+    def substring(self, query, limit):
+        if len(query) < NGRAM:
+            return [user_id for key, user_id in self.keys if query in key][:limit]
+        sets = sorted((self.grams.get(g, set()) for g in self.ngrams(query)), key=len)
+        candidates = set(sets[0]).intersection(*sets[1:])
+        return sorted(u for u in candidates if query in str(u).lower())[:limit]
+
+    # 前綴相符的排在前面，其後才是其他位置含有查詢字串的使用者；空查詢回傳字母順序的前幾位
+    def search(self, query, limit=20):
+        query = str(query).strip().lower()
+        result = self.prefix(query, limit)
+        if len(result) < limit and query:
+            seen = set(result)
+            result += [u for u in self.substring(query, limit + len(seen)) if u not in seen][:limit - len(result)]
+        return result
+
+
+# 群組 → 成員、成員 → 群組的雙向索引；由型別化檢視建立，groups 已是 list
+class GroupIndex:
+    def __init__(self, df):
+        self.members = defaultdict(set)
+        self.groups_of = defaultdict(set)
+        self.update_rows(df.iloc[0:0], df)
+
+    def update_rows(self, old_rows, new_rows):
+        for user_id, groups in zip(old_rows['user_id'], old_rows['groups']):
+            for g in groups:
+                self.members[g].discard(user_id)
+                self.groups_of[user_id].discard(g)
+                if not self.members[g]:
+                    del self.members[g]
+            if user_id in self.groups_of and not self.groups_of[user_id]:
+                del self.groups_of[user_id]
+        for user_id, groups in zip(new_rows['user_id'], new_rows['groups']):
+            if not user_id:
+                continue
+            for g in groups:
+                self.members[g].add(user_id)
+                self.groups_of[user_id].add(g)
+
+    def exists(self, group_name):
+        return bool(self.members.get(group_name))
+
+    def members_of(self, group_name):
+        return sorted(self.members.get(group_name, ()))
+
+    def groups_for(self, user_id):
+        return sorted(self.groups_of.get(user_id, ()))
+
+
+# 好友關係的鄰接集合與待回覆申請；每位使用者的資料只來自自己那一列（型別化檢視，名單已是 list）
+class FriendGraph:
+    def __init__(self, df):
+        self.friends = {}
+        self.requests = {}
+        self.update_rows(df.iloc[0:0], df)
+
+    def update_rows(self, old_rows, new_rows):
+        for user_id in old_rows['user_id']:
+            self.friends.pop(user_id, None)
+            self.requests.pop(user_id, None)
+        for user_id, friends, requests in zip(new_rows['user_id'], new_rows['friends'], new_rows['friend_requests']):
+            if user_id:
+                self.friends[user_id] = set(friends)
+                self.requests[user_id] = set(requests)
+
+    def has_user(self, user_id):
+        return user_id in self.friends
+
+    def are_friends(self, a, b):
+        return b in self.friends.get(a, ())
+
+    def has_pending(self, user_id, requester):
+        return requester in self.requests.get(user_id, ())
+
+    def friends_of(self, user_id):
+        return sorted(self.friends.get(user_id, ()))
+
+    def pending_for(self, user_id):
+        return sorted(self.requests.get(user_id, ()))
+
+    # 朋友的朋友依共同好友數排序；兩層 BFS，最多走訪 max_visits 條邊
+    def suggest(self, user_id, k=10, max_visits=5000):
+        direct = self.friends.get(user_id, set())
+        mutual = Counter()
+        visits = 0
+        for friend in sorted(direct):
+            for candidate in self.friends.get(friend, ()):
+                visits += 1
+                if candidate != user_id and candidate not in direct:
+                    mutual[candidate] += 1
+            if visits >= max_visits:
+                break
+        return heapq.nsmallest(k, mutual.items(), key=lambda item: (-item[1], item[0]))
+
+
+# 活動主鍵索引（activity_id → 活動資料）與群組次索引（group_name → activity_id 集合）；
+# 由型別化檢視建立，event_date 為日期（無法解析時為 NaT）、參加名單為 list
+class EventIndex:
+    def __init__(self, df):
+        self.rows = {}
+        self.labels = {}
+        self.by_group = defaultdict(set)
+        self.update_rows(df.iloc[0:0], df)
+
+    def update_rows(self, old_rows, new_rows):
+        for label, activity_id, group_name in zip(old_rows.index, old_rows['activity_id'], old_rows['group_name']):
+            if activity_id and self.labels.get(activity_id) == label:
+                del self.labels[activity_id]
+                del self.rows[activity_id]
+                self.by_group[group_name].discard(activity_id)
+                if not self.by_group[group_name]:
+                    del self.by_group[group_name]
+        for label, row in zip(new_rows.index, new_rows.to_dict('records')):
+            activity_id = row['activity_id']
+            if activity_id:
+                self.labels[activity_id] = label
+                self.rows[activity_id] = row
+                self.by_group[row['group_name']].add(activity_id)
+
+    def get(self, activity_id):
+        return self.rows.get(activity_id)
+
+    def for_group(self, group_name):
+        return [self.rows[a] for a in list(self.by_group.get(group_name, ()))]
+
+    def all(self):
+        return list(self.rows.values())
+
+
+def availability_window_start():
+    return date.today() - timedelta(days=BITMAP_PAST_DAYS)
+
+def get_availability_index():
+    start = availability_window_start()
+    return get_index(f"availability:{start.isoformat()}", lambda df: AvailabilityIndex(df, start), typed=True)
+
+def get_availability_matrix():
+    today = date.today()
+    start = availability_window_start()
+    return get_index(f"availability_matrix:{today.isoformat()}", lambda df: AvailabilityMatrix(df, start), typed=True)
+
+def get_slot_index():
+    today = date.today()
+    return get_index(f"slots:{today.isoformat()}", lambda df: SlotIndex(df, today), typed=True)
+
+def match_index_name(day):
+    return f"matches:{day.isoformat()}"
+
+# 配對索引要建立數秒，不在讀取端持有資料表的 lock 建立：沒有目前版本的索引時（剛啟動、換日、
+# 外部修改後）交給背景執行緒，先回傳舊版本或前一天的索引，都沒有時回傳 None
+def get_match_index():
+    today = date.today()
+    index, current = peek_index(match_index_name(today))
+    if current:
+        return index
+    request_warm()
+    if index is None:
+        index, _ = peek_index(match_index_name(today - timedelta(days=1)))
+    return index
+
+_warm_lock = threading.Lock()
+
+# 預先建立今天的配對索引與其他建立在型別化檢視上的索引，第一次開啟頁面時不必等待；
+# 同一時間只有一個執行緒在建立
+def warm_indexes():
+    with _warm_lock:
+        today = date.today()
+        warm_index(match_index_name(today), lambda df: MatchIndex(df, today), typed=True)
+        warm_index("friends", FriendGraph, typed=True)
+        warm_index("groups", GroupIndex, typed=True)
+        warm_index("events", EventIndex, table="events", typed=True)
+
+# 讀取端發現索引過期時呼叫：另開背景執行緒建立，已在建立中則不重複
+def request_warm():
+    if _warm_lock.locked():
+        return
+
+    def run():
+        try:
+            with background():
+                warm_indexes()
+        except Exception:
+            logging.exception("索引預先建立失敗")
+    threading.Thread(target=run, name="nojo-index-warm", daemon=True).start()
+
+def get_user_rows():
+    return get_index("user_rows", UserRowIndex)
+
+def get_user_search_index():
+    return get_index("user_search", UserSearchIndex)
+
+def get_friend_graph():
+    return get_index("friends", FriendGraph, typed=True)
+
+def get_group_index():
+    return get_index("groups", GroupIndex, typed=True)
+
+# 在工作區中找出使用者所在列；索引可能尚未包含同批次新增的列，找不到時退回逐列比對
+def find_user_label(df, user_id):
+    label = get_user_rows().labels.get(user_id)
+    if label is not None and label in df.index and df.at[label, 'user_id'] == user_id:
+        return label
+    matches = df.index[df['user_id'] == user_id]
+    return matches[0] if len(matches) else None
+
+def get_event_index():
+    return get_index("events", EventIndex, table="events", typed=True)
+
+def get_archived_event_index():
+    return get_index("events_archive", EventIndex, table="events_archive", typed=True)
+
+def find_event_label(df, activity_id):
+    label = get_event_index().labels.get(activity_id)
+    if label is not None and label in df.index and df.at[label, 'activity_id'] == activity_id:
+        return label
+    matches = df.index[df['activity_id'] == activity_id]
+    return matches[0] if len(matches) else None
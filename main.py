@@ -5,137 +5,248 @@ import re
 import pandas as pd
 import plotly.graph_objects as go
 import uuid
-import gspread
+import logging
+import threading
 from datetime import datetime, timedelta, date
-from google.oauth2 import service_account
-#from storage_module import get_df, save_df
-
-#google sheet 初始化
-SHEET_NAME = "meeting_records"
-secrets = st.secrets["gspread"]
-credentials = service_account.Credentials.from_service_account_info(secrets)
-scoped_credentials = credentials.with_scopes([
-    "https://www.googleapis.com/auth/spreadsheets",
-    "https://www.googleapis.com/auth/drive"
-])
-client = gspread.authorize(scoped_credentials)
-sheet = client.open(SHEET_NAME).sheet1
-
-@st.cache_data(ttl=60)
-
+from storage_module import get_df, get_typed_df, get_row, get_versions, submit_mutation, transaction, background, quota_queue_depth, split_list, join_list, EVENT_COLUMNS
+from metrics_module import timer, instrument, profiled, counter_rows, timer_rows, reset_metrics
+from availability_module import WEEKDAY_NAMES, parse_rules, expand_window, build_rule_tokens, parse_slots, slot_token, describe_slot
+from index_module import get_user_search_index, get_availability_index, get_slot_index, get_match_index, warm_indexes, get_availability_matrix, get_group_index, get_friend_graph, get_event_index, get_archived_event_index, find_user_label, find_event_label
+
+EVENT_SWEEP_INTERVAL = 3600  # 秒，過期活動歸檔的執行間隔
+INDEX_WARM_INTERVAL = 600  # 秒，檢查配對索引是否需要預先建立的間隔
+REFRESH_CHECK_INTERVAL = 5  # 秒，檢查資料版本的間隔
+USER_SEARCH_LIMIT = 20  # 搜尋框最多列出的使用者數
+MATCH_LIMIT = 10  # 最佳配對列出的人數
+ADMIN_PAGE_SIZE = 50
+AVAILABILITY_PICK_DAYS = 90  # 登記頁面可直接點選的天數
+EVENT_DURATION = 120  # 分鐘，建議活動時間的長度
 
 def register_user(user_id, password):
     user_id, password = str(user_id), str(password)
     if len(password) < 6 or not re.search(r'[A-Za-z]', password):
         return False, "密碼必須至少 6 個字元，且包含英文字母"
-    df = get_df()
-    if user_id in df['user_id'].values:
-        return False, "使用者 ID 已存在"
-    new_entry = pd.DataFrame([{
-        'user_id': user_id,
-        'password': password,
-        'available_dates': '',
-        'friends': '',
-        'friend_requests': ''
-    }])
-    df = pd.concat([df, new_entry], ignore_index=True)
-    save_df(df)
-    return True, "註冊成功"
+
+    def apply(ws):
+        if user_id in ws.df['user_id'].values:
+            return False, "使用者 ID 已存在"
+        ws.append([{
+            'user_id': user_id,
+            'password': password,
+            'available_dates': '',
+            'friends': '',
+            'friend_requests': ''
+        }])
+        return True, "註冊成功"
+    return submit_mutation(apply)
 
 def authenticate_user(user_id, password):
-    df = get_df()
-    return not df[(df['user_id'] == str(user_id)) & (df['password'] == str(password))].empty
+    row = get_row('user_id', str(user_id))
+    return row is not None and str(row['password']) == str(password)
 
-def update_availability(user_id, available_dates):
-    df = get_df()
+# available_dates 為規則片段（單一日期、區間、每週規則、排除日），格式見 availability_module
+# slots 為小時層級的時段片段；None 表示不變動
+def update_availability(user_id, available_dates, slots=None):
     date_str = ','.join(available_dates)
-    df.loc[df['user_id'] == user_id, 'available_dates'] = date_str
-    save_df(df)
-    return date_str
 
+    def apply(ws):
+        idx = find_user_label(ws.df, user_id)
+        ws.touch([] if idx is None else [idx])
+        if idx is not None:
+            ws.df.at[idx, 'available_dates'] = date_str
+            if slots is not None:
+                ws.df.at[idx, 'available_slots'] = ','.join(slots)
+        return date_str
+    return submit_mutation(apply)
+
+# 登記可用時間：單一日期、日期區間、每週固定與排除日，預先帶入目前的規則
+def render_availability_form(user_id, days=AVAILABILITY_PICK_DAYS):
+    today = date.today()
+    row = get_row("user_id", user_id)
+    raw = row.get("available_dates", "") if row is not None else ""
+    rules = parse_rules(raw if isinstance(raw, str) else "")
+    horizon = [today + timedelta(days=i) for i in range(days)]
+
+    st.subheader("單一日期")
+    dates = st.multiselect("選擇可用日期", horizon, default=[d for d in horizon if d in rules.dates], format_func=lambda d: d.isoformat())
+    # 選單範圍以外、尚未過期的單一日期保留不動
+    later_dates = [d for d in rules.dates if d > horizon[-1]]
+
+    st.subheader("每週固定")
+    weekly = rules.weekly[0] if rules.weekly else (frozenset(), None, None)
+    weekdays = st.multiselect("每週可用", list(range(7)), default=sorted(weekly[0]), format_func=lambda w: f"星期{WEEKDAY_NAMES[w]}")
+    limit = st.checkbox("限定期間", value=bool(weekly[1] or weekly[2]))
+    weekly_span = (None, None)
+    if limit:
+        span = st.date_input("每週規則的期間", value=(weekly[1] or today, weekly[2] or today + timedelta(days=90)))
+        if len(span) == 2:
+            weekly_span = (span[0], span[1])
+
+    st.subheader("日期區間")
+    ranges = st.multiselect("保留的區間", rules.ranges, default=rules.ranges, format_func=lambda r: f"{r[0].isoformat()} ～ {r[1].isoformat()}")
+    new_range = st.date_input("新增區間", value=(), key="availability_new_range")
+    if len(new_range) == 2:
+        ranges = ranges + [(new_range[0], new_range[1])]
+
+    st.subheader("排除日期")
+    excluded = st.multiselect("這些日期不可用", horizon, default=[d for d in horizon if d in rules.excluded_dates], format_func=lambda d: d.isoformat())
+    later_excluded = [d for d in rules.excluded_dates if d > horizon[-1]]
+
+    st.subheader("時段")
+    # 已過去的單日時段不再列出，儲存時一併清掉
+    raw_slots = row.get("available_slots", "") if row is not None else ""
+    current = [slot for slot in parse_slots(raw_slots if isinstance(raw_slots, str) else "") if slot[0] is None or slot[0] >= today]
+    slots = st.multiselect("保留的時段", current, default=current, format_func=lambda slot: describe_slot(*slot))
+    if st.checkbox("新增時段", key="availability_add_slot"):
+        kind = st.radio("時段類型", ["每週", "單日"], horizontal=True, key="availability_slot_kind")
+        if kind == "每週":
+            slot_day, slot_weekday = None, st.selectbox("星期", list(range(7)), format_func=lambda w: f"星期{WEEKDAY_NAMES[w]}", key="availability_slot_weekday")
+        else:
+            slot_day, slot_weekday = st.date_input("日期", value=today, min_value=today, key="availability_slot_day"), None
+        c1, c2 = st.columns(2)
+        slot_start = c1.time_input("開始", value=datetime.strptime("19:00", "%H:%M").time(), key="availability_slot_start")
+        slot_end = c2.time_input("結束", value=datetime.strptime("21:00", "%H:%M").time(), key="availability_slot_end")
+        start_min = slot_start.hour * 60 + slot_start.minute
+        end_min = slot_end.hour * 60 + slot_end.minute
+        if end_min <= start_min:
+            end_min += 24 * 60
+        slots = slots + [(slot_day, slot_weekday, start_min, end_min)]
+
+    if st.button("更新"):
+        weekly_rules = [(weekdays, *weekly_span)] + rules.weekly[1:]
+        tokens = build_rule_tokens(dates + later_dates, ranges, weekly_rules, excluded + later_excluded, rules.excluded_ranges, since=today)
+        update_availability(user_id, tokens, list(dict.fromkeys(slot_token(*slot) for slot in slots)))
+        st.success("已更新可用時間")
+
+WEEK_HEADERS = ['一', '二', '三', '四', '五', '六', '日']
+
+def shift_month(year, month, delta):
+    index = year * 12 + (month - 1) + delta
+    return index // 12, index % 12 + 1
+
+# 月曆格子（每週一列，0 表示不屬於該月）只計算一次
+@st.cache_resource
+def month_grid(year, month):
+    return tuple(tuple(week) for week in calendar.Calendar(firstweekday=0).monthdayscalendar(year, month))
+
+# 單月 HTML 依 (年, 月, 空閒規則原始字串) 快取，字串不變就不重新產生；規則只展開這個月
+@st.cache_data(max_entries=5000)
+def render_month_html(year, month, available_raw):
+    available = expand_window(available_raw, date(year, month, 1), calendar.monthrange(year, month)[1])
+    parts = [
+        "<table style='border-collapse: collapse; width: 100%; text-align: center;'>",
+        f"<caption style='text-align:center; font-weight:bold; padding: 8px'>{year} 年 {month} 月</caption>",
+        "<tr>", "".join(f"<th>{d}</th>" for d in WEEK_HEADERS), "</tr>",
+    ]
+    for week in month_grid(year, month):
+        parts.append("<tr>")
+        for day in week:
+            if day == 0:
+                parts.append("<td></td>")
+            elif f"{year}-{month:02d}-{day:02d}" in available:
+                parts.append(f"<td style='background-color:#b2fab4;border:1px solid #ccc;padding:5px'>{day}</td>")
+            else:
+                parts.append(f"<td style='border:1px solid #ccc;padding:5px;color:#ccc'>{day}</td>")
+        parts.append("</tr>")
+    parts.append("</table>")
+    return "".join(parts)
+
+# 多個月份並排（例如一季），一次組成一段 HTML
+def render_months_html(year, month, count, available_raw):
+    if count == 1:
+        return render_month_html(year, month, available_raw)
+    cells = []
+    for i in range(count):
+        y, m = shift_month(year, month, i)
+        cells.append(f"<div style='flex:1;min-width:220px'>{render_month_html(y, m, available_raw)}</div>")
+    return f"<div style='display:flex;gap:12px;flex-wrap:wrap'>{''.join(cells)}</div>"
+
+def shift_calendar(year_key, month_key, delta):
+    st.session_state[year_key], st.session_state[month_key] = shift_month(st.session_state[year_key], st.session_state[month_key], delta)
+
+# 片段：切換月份只重新執行日曆本身，資料來自共用快取
+@st.fragment
+@instrument("display_calendar_view")
 def display_calendar_view(user_id):
     today = datetime.today()
-    now = time.time()
 
     # 狀態 key 命名
     year_key = f"{user_id}_show_year"
     month_key = f"{user_id}_show_month"
-    last_click_key = f"{user_id}_last_click"
     last_user_key = "last_display_user"
 
     # 初始化
     if last_user_key not in st.session_state or st.session_state[last_user_key] != user_id:
         st.session_state[year_key] = today.year
         st.session_state[month_key] = today.month
-        st.session_state[last_click_key] = 0.0
         st.session_state[last_user_key] = user_id
 
-    # 防止多次快速點擊
-    can_click = now - st.session_state[last_click_key] > 1.0
+    quarter = st.toggle("一次顯示三個月", key=f"quarter_{user_id}")
+    step = 3 if quarter else 1
 
     # 月份控制
     col1, col2, col3 = st.columns([1, 2, 1])
     with col1:
-        if st.button("← 上一個月", key=f"prev_btn_{user_id}") and can_click:
-            st.session_state[last_click_key] = now
-            if st.session_state[month_key] == 1:
-                st.session_state[month_key] = 12
-                st.session_state[year_key] -= 1
-            else:
-                st.session_state[month_key] -= 1
+        st.button("← 上一個月", key=f"prev_btn_{user_id}", on_click=shift_calendar, args=(year_key, month_key, -step))
     with col3:
-        if st.button("下一個月 →", key=f"next_btn_{user_id}") and can_click:
-            st.session_state[last_click_key] = now
-            if st.session_state[month_key] == 12:
-                st.session_state[month_key] = 1
-                st.session_state[year_key] += 1
-            else:
-                st.session_state[month_key] += 1
+        st.button("下一個月 →", key=f"next_btn_{user_id}", on_click=shift_calendar, args=(year_key, month_key, step))
 
     year = st.session_state[year_key]
     month = st.session_state[month_key]
 
-    # 資料抓取與檢查
-    df = get_df()
-    user_data = df[df["user_id"] == user_id]
-    if user_data.empty:
+    # 資料抓取與檢查（快取有效時由記憶體索引取得，不會讀取儲存端）
+    user_data = get_row("user_id", user_id)
+    if user_data is None:
         st.warning(f"{user_id} 無資料")
         return
 
-    available_raw = user_data.iloc[0].get("available_dates", "")
+    available_raw = user_data.get("available_dates", "")
     if not isinstance(available_raw, str):
         available_raw = ""
-    available = set(d.strip() for d in available_raw.split(",") if d.strip())
-
-    cal = calendar.Calendar(firstweekday=0)
-    month_days = list(cal.itermonthdays(year, month))
-
-    week_headers = ['一', '二', '三', '四', '五', '六', '日']
-    table = "<table style='border-collapse: collapse; width: 100%; text-align: center;'>"
-    table += f"<caption style='text-align:center; font-weight:bold; padding: 8px'>{year} 年 {month} 月</caption>"
-    table += "<tr>" + "".join(f"<th>{d}</th>" for d in week_headers) + "</tr><tr>"
 
-    day_counter = 0
-    for day in month_days:
-        if day == 0:
-            table += "<td></td>"
-        else:
-            date_str = f"{year}-{month:02d}-{day:02d}"
-            if date_str in available:
-                table += f"<td style='background-color:#b2fab4;border:1px solid #ccc;padding:5px'>{day}</td>"
-            else:
-                table += f"<td style='border:1px solid #ccc;padding:5px;color:#ccc'>{day}</td>"
-        day_counter += 1
-        if day_counter % 7 == 0:
-            table += "</tr><tr>"
-    table += "</tr></table>"
+    st.markdown(render_months_html(year, month, step, available_raw), unsafe_allow_html=True)
 
-    st.markdown(table, unsafe_allow_html=True)
+    # 預先產生前後月份，切換時直接命中快取
+    for delta in (-step, step):
+        render_months_html(*shift_month(year, month, delta), step, available_raw)
 
 def find_users_by_date(date, current_user_id):
-    df = get_df()
-    return df[(df['available_dates'].str.contains(date, na=False)) & 
-              (df['user_id'] != current_user_id)]['user_id'].tolist()
+    users = get_availability_index().users_on(date)
+    return sorted(u for u in users if u != current_user_id)
+
+# 多日期查詢：mode="all" 為每天都有空，mode="any" 為任一天有空
+def find_users_by_dates(dates, current_user_id, mode="all"):
+    index = get_availability_index()
+    users = index.users_on_all(dates) if mode == "all" else index.users_on_any(dates)
+    return sorted(u for u in users if u != current_user_id)
+
+def find_users_in_range(start_date, end_date, current_user_id):
+    users = get_availability_index().users_in_range(start_date, end_date)
+    return sorted(u for u in users if u != current_user_id)
+
+# 未來空閒日重疊最多的使用者 [(使用者, Jaccard 分數, 共同天數)]，由預先算好的排行直接取出；
+# 排行還在背景計算中時回傳 None
+def top_matches(user_id, k=MATCH_LIMIT):
+    index = get_match_index()
+    return None if index is None else index.top_matches(user_id, k)
+
+# start、end 為 datetime；整段時間都有空的使用者
+def find_users_in_slot(start, end, current_user_id):
+    users = get_slot_index().users_free(start, end)
+    return sorted(u for u in users if u != current_user_id)
+
+def search_users(query, current_user_id, limit=USER_SEARCH_LIMIT):
+    return [u for u in get_user_search_index().search(query, limit + 1) if u != current_user_id][:limit]
+
+# 輸入部分 ID 即時搜尋，只把符合的前幾位放進下拉選單
+def user_search_picker(label, key, current_user_id):
+    query = st.text_input(label, key=f"{key}_query", placeholder="輸入 ID 開頭或部分字元搜尋")
+    matches = search_users(query, current_user_id)
+    if not matches:
+        if query:
+            st.caption("找不到符合的使用者")
+        return None
+    return st.selectbox("搜尋結果", matches, key=f"{key}_select", label_visibility="collapsed")
 
 def confirm_action(label, key=None, warn_text="此動作不可復原，請再次確認！"):
     st.markdown(
@@ -151,142 +262,176 @@ def send_friend_request(current_user, target_user):
     if current_user == target_user:
         return "不能傳送好友申請給自己"
 
-    df = get_df()
-
-    if target_user not in df["user_id"].values:
+    graph = get_friend_graph()
+    if not graph.has_user(target_user):
         return "該使用者不存在"
-
-    curr_friends_raw = df.loc[df["user_id"] == current_user, "friends"].values[0]
-    curr_friends_set = set(f.strip() for f in curr_friends_raw.split(",") if f.strip())
-
-    if target_user in curr_friends_set:
+    if graph.are_friends(current_user, target_user):
         return "對方已經是你的好友"
-
-    target_requests = df.loc[df["user_id"] == target_user, "friend_requests"].values[0]
-    target_requests_set = set(target_requests.split(",")) if target_requests else set()
-
-    if current_user in target_requests_set:
+    if graph.has_pending(target_user, current_user):
         return "已送出好友申請 請等待對方回應"
 
-    target_requests_set.add(current_user)
-    df.loc[df["user_id"] == target_user, "friend_requests"] = ",".join(sorted(target_requests_set))
-    save_df(df)
-    return "好友申請已送出"
-
-def accept_friend_request(user_id, requester):
-    df = get_df()
-    idx = df[df['user_id'] == user_id].index[0]
-    friends = set(df.at[idx, 'friends'].split(',')) if df.at[idx, 'friends'] else set()
-    friends.add(requester)
-    df.at[idx, 'friends'] = ','.join(sorted(friends))
+    def apply(ws):
+        df = ws.df
+        idx = find_user_label(df, target_user)
+        if idx is None:
+            return "該使用者不存在"
+        ws.touch([idx])
 
-    req_idx = df[df['user_id'] == requester].index[0]
-    req_friends = set(df.at[req_idx, 'friends'].split(',')) if df.at[req_idx, 'friends'] else set()
-    req_friends.add(user_id)
-    df.at[req_idx, 'friends'] = ','.join(sorted(req_friends))
+        # 以最新資料再確認一次，避免同批次的重複申請
+        target_requests_set = set(split_list(df.at[idx, "friend_requests"]))
+        if current_user in target_requests_set:
+            return "已送出好友申請 請等待對方回應"
 
-    requests = set(df.at[idx, 'friend_requests'].split(',')) if df.at[idx, 'friend_requests'] else set()
-    requests.discard(requester)
-    df.at[idx, 'friend_requests'] = ','.join(sorted(requests))
+        target_requests_set.add(current_user)
+        df.at[idx, "friend_requests"] = join_list(target_requests_set)
+        return "好友申請已送出"
+    return submit_mutation(apply)
 
-    save_df(df)
-    return "您已與對方成為好友"
+def accept_friend_request(user_id, requester):
+    def apply(ws):
+        df = ws.df
+        idx = find_user_label(df, user_id)
+        req_idx = find_user_label(df, requester)
+        if idx is None or req_idx is None:
+            return "該使用者不存在"
+        ws.touch([idx, req_idx])
+
+        friends = set(split_list(df.at[idx, 'friends']))
+        friends.add(requester)
+        df.at[idx, 'friends'] = join_list(friends)
+
+        req_friends = set(split_list(df.at[req_idx, 'friends']))
+        req_friends.add(user_id)
+        df.at[req_idx, 'friends'] = join_list(req_friends)
+
+        requests = set(split_list(df.at[idx, 'friend_requests']))
+        requests.discard(requester)
+        df.at[idx, 'friend_requests'] = join_list(requests)
+        return "您已與對方成為好友"
+    return submit_mutation(apply)
 
 def reject_friend_request(user_id, requester):
-    df = get_df()
-    idx = df[df['user_id'] == user_id].index[0]
-    requests = set(df.at[idx, 'friend_requests'].split(',')) if df.at[idx, 'friend_requests'] else set()
-    requests.discard(requester)
-    df.at[idx, 'friend_requests'] = ','.join(sorted(requests))
-    save_df(df)
-    return "已拒絕好友申請"
+    def apply(ws):
+        df = ws.df
+        idx = find_user_label(df, user_id)
+        if idx is not None:
+            ws.touch([idx])
+            requests = set(split_list(df.at[idx, 'friend_requests']))
+            requests.discard(requester)
+            df.at[idx, 'friend_requests'] = join_list(requests)
+        return "已拒絕好友申請"
+    return submit_mutation(apply)
 
 def list_friend_requests(user_id):
-    df = get_df()
-    user_row = df[df['user_id'] == user_id]
-    if user_row.empty:
-        return []   # 或直接 return None，看你前面怎麼判斷
-    idx = user_row.index[0]
-    requests_raw = df.at[idx, 'friend_requests']
-    return [r.strip() for r in requests_raw.split(',') if r.strip()] if requests_raw else []
+    return get_friend_graph().pending_for(user_id)
 
 
 def list_friends(user_id):
-    df = get_df()
-    idx = df[df['user_id'] == user_id].index[0]
-    friends = df.at[idx, 'friends']
-    return sorted(list(filter(None, friends.split(','))))
-
-def show_friends_availability(user_id):
-    df = get_df()
-    idx = df[df['user_id'] == user_id].index[0]
-    friends = df.at[idx, 'friends']
-    friends = list(filter(None, friends.split(',')))
+    return get_friend_graph().friends_of(user_id)
+
+# 按鈕回呼：在片段重新執行前完成寫入，並記下自己寫入後的版本
+def respond_friend_request(user_id, requester, accept):
+    if accept:
+        st.session_state.friend_request_msg = ("success", accept_friend_request(user_id, requester))
+    else:
+        st.session_state.friend_request_msg = ("info", reject_friend_request(user_id, requester))
+    remember_data_version()
+
+# 片段：接受／拒絕只重新執行申請清單
+@st.fragment
+def render_friend_requests(user_id):
+    msg = st.session_state.pop("friend_request_msg", None)
+    if msg:
+        kind, text = msg
+        st.success(text) if kind == "success" else st.info(text)
+
+    requests = list_friend_requests(user_id)
+    if not requests:
+        st.info("目前沒有好友申請")
+        return
+    for requester in requests:
+        col1, col2 = st.columns([2, 1])
+        with col1:
+            st.write(f"來自 {requester} 的好友申請")
+        with col2:
+            st.button("接受", key=f"accept_{requester}", on_click=respond_friend_request, args=(user_id, requester, True))
+            st.button("拒絕", key=f"reject_{requester}", on_click=respond_friend_request, args=(user_id, requester, False))
+
+# 推薦好友：朋友的朋友，依共同好友數排序，排除已送出申請的對象
+def suggest_friends(user_id, k=10):
+    graph = get_friend_graph()
+    return [(u, n) for u, n in graph.suggest(user_id, k=k * 2) if not graph.has_pending(u, user_id)][:k]
+
+# 使用者 × 日期的空閒熱度圖（bits 為 bool 矩陣，列順序與 users 相同）
+def render_availability_heatmap(users, dates, bits, title, row_height=24):
+    fig = go.Figure(go.Heatmap(
+        z=bits.astype(int),
+        x=dates,
+        y=users,
+        colorscale=[[0, "lightgray"], [1, "green"]],
+        zmin=0,
+        zmax=1,
+        showscale=False,
+        xgap=1,
+        ygap=1,
+    ))
+    fig.update_layout(title=title, height=max(200, row_height * len(users) + 120))
+    st.plotly_chart(fig, width="stretch")
+
+@instrument("show_friends_availability")
+def show_friends_availability(user_id, days=30):
+    friends = list_friends(user_id)
     if not friends:
         st.info("目前尚無好友")
         return
 
     st.subheader("好友的空閒日期")
-    if "friend_view_states" not in st.session_state:
-        st.session_state.friend_view_states = {}
-
-    today = datetime.today()
-    next_30_days = [today + timedelta(days=i) for i in range(30)]
-    date_labels = [d.strftime("%Y-%m-%d") for d in next_30_days]
-
-    for friend in friends:
-        if friend not in st.session_state.friend_view_states:
-            st.session_state.friend_view_states[friend] = False
 
-        with st.expander(f"{friend}", expanded=st.session_state.friend_view_states[friend]):
-            friend_data = df[df['user_id'] == friend]
-            if not friend_data.empty:
-                dates = friend_data.iloc[0]['available_dates']
-                available_set = set(d.strip() for d in dates.split(',') if d.strip())
-
-                calendar_df = pd.DataFrame({
+    # 好友 × 未來日期的矩陣一次取出，畫成單一熱度圖
+    today = date.today()
+    matrix = get_availability_matrix()
+    date_labels = matrix.date_labels(today, days)
+    friend_bits = matrix.rows(friends, today, days)
+    render_availability_heatmap(friends, date_labels, friend_bits, "未來可用日")
+
+    # 個別好友明細只在展開時才產生
+    for i, friend in enumerate(friends):
+        detail = st.expander(f"{friend}", key=f"friend_detail_{friend}", on_change="rerun")
+        if detail.open:
+            with detail:
+                if friend not in matrix.user_pos:
+                    st.warning("找不到該使用者資料")
+                    continue
+                st.table(pd.DataFrame({
                     "日期": date_labels,
-                    "可用": ["是" if d in available_set else "否" for d in date_labels]
-                })
-                st.table(calendar_df)
-
-                fig = go.Figure(go.Bar(
-                    x=date_labels,
-                    y=[1 if d in available_set else 0 for d in date_labels],
-                    marker_color=["green" if d in available_set else "lightgray" for d in date_labels],
-                ))
-                fig.update_layout(
-                    title="未來可用日",
-                    xaxis_title="日期",
-                    yaxis=dict(showticklabels=False),
-                    height=300
-                )
-                st.plotly_chart(fig, use_container_width=True)
+                    "可用": ["是" if b else "否" for b in friend_bits[i]]
+                }))
 
 def show_friend_list_with_availability(user_id):
-    df = get_df()
     friends = list_friends(user_id)
 
     if not friends:
         st.info("您目前尚無好友")
     else:
+        # 先以熱度圖總覽所有好友，再選一位好友看日曆與規則明細
+        show_friends_availability(user_id)
         selected_friend = st.selectbox("選擇好友查看空閒時間", friends)
 
         if selected_friend:
-            friend_data = df[df["user_id"] == selected_friend]
+            friend_data = get_row("user_id", selected_friend)
 
             try:
                 display_calendar_view(selected_friend)
             except Exception as e:
                 st.error(f"{selected_friend} 的日曆顯示失敗：{e}")
 
-            if not friend_data.empty:
-                dates = friend_data.iloc[0].get("available_dates", "")
+            if friend_data is not None:
+                dates = friend_data.get("available_dates", "")
                 if not isinstance(dates, str):
                     dates = ""
-                date_list = [d.strip() for d in dates.split(",") if d.strip()]
+                date_list = parse_rules(dates).describe()
                 if date_list:
-                    st.markdown(f"**空閒時間**：{'、'.join(date_list)}")
+                    st.markdown(f"**空閒時間**：{'；'.join(date_list)}")
                 else:
                     st.info("尚未登記可用時間")
             else:
@@ -294,88 +439,242 @@ def show_friend_list_with_availability(user_id):
                 date_list = [d.strip() for d in dates.split(',')] if dates else []
                 st.markdown(f" **空閒時間**：{'、'.join(date_list) if date_list else '尚未登記'}")
 
+# 舊版把活動存在使用者工作表（row_type == 'event'），每個程序啟動時檢查一次並搬到獨立的活動表
+@st.cache_resource
+def migrate_event_rows():
+    def apply(ws):
+        df = ws.df
+        legacy = df[df['row_type'] == 'event']
+        if legacy.empty:
+            return 0
+        moved = legacy.reindex(columns=EVENT_COLUMNS).fillna("")
+        # 沒有 activity_id 的舊活動依內容產生固定的 id，重跑時才認得出已搬過的列
+        missing = moved['activity_id'] == ""
+        moved.loc[missing, 'activity_id'] = [
+            str(uuid.uuid5(uuid.NAMESPACE_OID, "|".join(str(v) for v in row)))
+            for row in moved.loc[missing].itertuples(index=False)
+        ]
+        # 上次搬移時活動表已寫入、使用者表尚未刪除的列不再重複新增
+        moved = moved[~moved['activity_id'].isin(ws.events['activity_id'].astype(str))]
+        ws.append(moved.to_dict("records"), table="events")
+        ws.drop(legacy.index)
+        return len(legacy)
+    return submit_mutation(apply)
+
 # 建立活動
-def add_event_row(group_name, event_title, event_date, created_by, event_summary):
-    df = get_df()
-    for col in ["row_type", "activity_id", "group_name", "event_title", "event_date", "created_by", "event_summary", "participants_yes", "participants_no"]:
-        if col not in df.columns:
-            df[col] = ""
+def add_event_row(group_name, event_title, event_date, created_by, event_summary, event_time=""):
     new_row = {
-        "row_type": "event",
         "activity_id": str(uuid.uuid4()),
         "group_name": group_name,
         "event_title": event_title,
         "event_date": event_date,
+        "event_time": event_time,
         "created_by": created_by,
         "event_summary": event_summary,
         "participants_yes": "",
-        "participants_no": ""
+        "participants_no": "",
+        "yes_count": 0,
+        "no_count": 0
     }
-    df = pd.concat([df, pd.DataFrame([new_row])], ignore_index=True)
-    save_df(df)
-
-# 查詢活動（自動排除過期活動，並清理資料庫）
-def get_event_rows(group_name=None, auto_clean=True):
-    df = get_df()
-    if 'row_type' not in df.columns:
-        return pd.DataFrame()
-    events = df[df['row_type'] == 'event']
-    today_str = date.today().strftime("%Y-%m-%d")
-    # 篩選群組
-    if group_name is not None:
-        events = events[events['group_name'] == group_name]
-    # 自動移除過期活動
-    if auto_clean:
-        valid_idx = events[events["event_date"] >= today_str].index
-        expired_idx = events[events["event_date"] < today_str].index
-        if len(expired_idx) > 0:
-            df = df.drop(expired_idx)
-            save_df(df)
-        return events.loc[valid_idx]
-    else:
-        return events
+
+    def apply(ws):
+        ws.append([new_row], table="events")
+    submit_mutation(apply)
+    return new_row["activity_id"]
+
+# 活動索引的 event_date 為日期型別，顯示與排序時轉回 YYYY-MM-DD（無法解析的日期為空字串）
+def format_event_date(value):
+    return "" if pd.isna(value) else value.strftime("%Y-%m-%d")
+
+# 查詢活動（預設略過過期活動，只讀不寫）
+def get_event_rows(group_name=None, include_past=False):
+    index = get_event_index()
+    rows = index.all() if group_name is None else index.for_group(group_name)
+    if not include_past:
+        today = pd.Timestamp(date.today())
+        rows = [r for r in rows if r['event_date'] >= today]
+    if not rows:
+        return pd.DataFrame(columns=EVENT_COLUMNS)
+    rows.sort(key=lambda r: (format_event_date(r['event_date']), r['activity_id']))
+    return pd.DataFrame(rows)
 
 # 取得單一活動資料
 def get_event_by_id(activity_id):
-    df = get_df()
-    rows = df[df['activity_id'] == activity_id]
-    if rows.empty:
+    row = get_event_index().get(activity_id)
+    if row is None:
         return None
-    return rows.iloc[0]
-
-# 更新參加/不參加名單
-def update_event_participation_by_id(activity_id, yes_list, no_list):
-    df = get_df()
-    idx_list = df[df['activity_id'] == activity_id].index
-    if not idx_list.empty:
-        idx = idx_list[0]
-        df.at[idx, "participants_yes"] = ",".join(yes_list)
-        df.at[idx, "participants_no"] = ",".join(no_list)
-        save_df(df)
+    return pd.Series(row)
+
+# 參加人數：優先使用已存的計數欄，舊資料沒有時才數名單
+def event_counts(row):
+    counts = []
+    for count_col, list_col in (("yes_count", "participants_yes"), ("no_count", "participants_no")):
+        value = row.get(count_col)
+        counts.append(int(value) if pd.notna(value) else len(row.get(list_col, [])))
+    return tuple(counts)
+
+# 單一成員的參加狀態：status 為 "yes"、"no" 或 None（取消選擇），套用在最新的活動列上
+def rsvp_event(activity_id, user_id, status):
+    def apply(ws):
+        idx = find_event_label(ws.events, activity_id)
+        ws.touch([] if idx is None else [idx], table="events")
+        if idx is None:
+            return None
+        yes_list = [u for u in split_list(str(ws.events.at[idx, "participants_yes"])) if u != user_id]
+        no_list = [u for u in split_list(str(ws.events.at[idx, "participants_no"])) if u != user_id]
+        if status == "yes":
+            yes_list.append(user_id)
+        elif status == "no":
+            no_list.append(user_id)
+        ws.events.at[idx, "participants_yes"] = ",".join(yes_list)
+        ws.events.at[idx, "participants_no"] = ",".join(no_list)
+        ws.events.at[idx, "yes_count"] = len(yes_list)
+        ws.events.at[idx, "no_count"] = len(no_list)
+        return yes_list, no_list
+    return submit_mutation(apply)
 
 # 刪除活動
 def delete_event_by_id(activity_id):
-    df = get_df()
-    df = df[df['activity_id'] != activity_id].reset_index(drop=True)
-    save_df(df)
+    def apply(ws):
+        idx = find_event_label(ws.events, activity_id)
+        ws.drop([] if idx is None else [idx], table="events")
+    submit_mutation(apply)
     return True
 
+# 把過期活動一次搬到歸檔表，活動表只保留未來的活動
+def sweep_expired_events():
+    today_str = date.today().strftime("%Y-%m-%d")
+
+    def apply(ws):
+        expired = ws.events[ws.events['event_date'].astype(str) < today_str]
+        if expired.empty:
+            ws.touch([], table="events")
+            return 0
+        # 上次歸檔時歸檔表已寫入、活動表尚未刪除的活動不再重複歸檔
+        archive_ids = ws.table("events_archive")['activity_id'].astype(str)
+        archived = expired[~expired['activity_id'].astype(str).isin(archive_ids)]
+        ws.append(archived.assign(archived_at=today_str).to_dict("records"), table="events_archive")
+        ws.drop(expired.index, table="events")
+        return len(archived)
+    return submit_mutation(apply)
+
+# 每個程序只啟動一個背景執行緒，依固定間隔歸檔，不在畫面渲染時寫入
+@st.cache_resource
+def start_event_sweeper(interval=EVENT_SWEEP_INTERVAL):
+    def run():
+        while True:
+            try:
+                with background():
+                    sweep_expired_events()
+            except Exception:
+                logging.exception("過期活動歸檔失敗")
+            time.sleep(interval)
+    thread = threading.Thread(target=run, name="nojo-event-sweeper", daemon=True)
+    thread.start()
+    return thread
+
+# 每個程序只啟動一個背景執行緒，預先建立當天的配對索引與好友、群組、活動索引
+# （已建立時只是查一次快取）；換日時立即醒來建立新的一天
+@st.cache_resource
+def start_index_warmer(interval=INDEX_WARM_INTERVAL):
+    def run():
+        while True:
+            try:
+                with background():
+                    warm_indexes()
+            except Exception:
+                logging.exception("索引預先建立失敗")
+            tomorrow = datetime.combine(date.today() + timedelta(days=1), datetime.min.time())
+            time.sleep(min(interval, (tomorrow - datetime.now()).total_seconds() + 1))
+    thread = threading.Thread(target=run, name="nojo-index-warmer", daemon=True)
+    thread.start()
+    return thread
+
+# 歷史活動：已歸檔的活動加上尚未歸檔的過期活動
+def get_past_event_rows(group_name):
+    today = pd.Timestamp(date.today())
+    rows = get_archived_event_index().for_group(group_name)
+    archived = {r['activity_id'] for r in rows}
+    rows += [r for r in get_event_index().for_group(group_name) if not r['event_date'] >= today and r['activity_id'] not in archived]
+    if not rows:
+        return pd.DataFrame(columns=EVENT_COLUMNS)
+    rows.sort(key=lambda r: format_event_date(r['event_date']), reverse=True)
+    return pd.DataFrame(rows)
+
+# 按鈕回呼：寫入參加狀態，訊息留到片段重新執行時顯示
+def set_rsvp(activity_id, user_id, status, msg):
+    rsvp_event(activity_id, user_id, status)
+    st.session_state[f"rsvp_msg_{activity_id}"] = msg
+    remember_data_version()
+
+# 片段：參加／不參加只重新執行這個活動的區塊，名單由活動索引取得
+@st.fragment
+def render_event_rsvp(activity_id, user_id):
+    row = get_event_by_id(activity_id)
+    if row is None:
+        st.info("活動已不存在")
+        return
+    msg = st.session_state.pop(f"rsvp_msg_{activity_id}", None)
+    if msg:
+        st.success(msg)
+
+    yes_count, no_count = event_counts(row)
+    st.markdown(f"參加人數：{yes_count}（不參加 {no_count}）")
+    yes_list = row['participants_yes']
+    no_list = row['participants_no']
+
+    # 只有沒選過的人才能選
+    if user_id not in yes_list and user_id not in no_list:
+        c1, c2 = st.columns(2)
+        with c1:
+            st.button("參加", key=f"join_{activity_id}", on_click=set_rsvp, args=(activity_id, user_id, "yes", "已標記參加"))
+        with c2:
+            st.button("不參加", key=f"notjoin_{activity_id}", on_click=set_rsvp, args=(activity_id, user_id, "no", "已標記不參加"))
+    elif user_id in yes_list:
+        st.info("你已選擇參加")
+        st.button("取消參加", key=f"leave_yes_{activity_id}", on_click=set_rsvp, args=(activity_id, user_id, None, "已取消參加"))
+    elif user_id in no_list:
+        st.info("你已選擇不參加")
+        st.button("重新選擇", key=f"leave_no_{activity_id}", on_click=set_rsvp, args=(activity_id, user_id, None, "已取消不參加"))
+
+    # 展示名單
+    st.write("目前參加名單")
+    st.write("參加：", yes_list if yes_list else "尚無人參加")
+    st.write("不參加：", no_list if no_list else "尚無人標記不參加")
+
+# 由成員登記的時段找出最多人有空、長度足夠的時間 (開始, 結束, 人數)，沒有則為 None
+def suggest_event_window(group_name, minutes=EVENT_DURATION):
+    members = get_group_index().members_of(group_name)
+    return get_slot_index().best_window(members, timedelta(minutes=minutes), after=datetime.now())
+
 # UI: 活動清單渲染（for群組活動頁）
+@instrument("render_group_events_ui")
 def render_group_events_ui(group_name, user_id):
     st.subheader(f"{group_name} 群組活動")
-    # 活動建立 UI
+    # 活動建立 UI（日期與時間預先帶入最多成員有空的時段）
     st.markdown("### 建立新活動")
+    suggestion = suggest_event_window(group_name)
+    if suggestion:
+        start, end, count = suggestion
+        total = len(get_group_index().members_of(group_name))
+        st.caption(f"建議時間：{start:%Y-%m-%d %H:%M} ～ {end:%m-%d %H:%M}（{count}/{total} 人有空）")
+        suggested_end = min(end, start + timedelta(minutes=EVENT_DURATION))
     event_title = st.text_input("活動名稱", key=f"title_{group_name}")
-    event_date = st.date_input("活動日期", key=f"date_{group_name}")
+    event_date = st.date_input("活動日期", value=suggestion[0].date() if suggestion else "today", key=f"date_{group_name}")
+    c1, c2 = st.columns(2)
+    start_time = c1.time_input("開始時間", value=suggestion[0].time() if suggestion else None, key=f"start_{group_name}")
+    end_time = c2.time_input("結束時間", value=suggested_end.time() if suggestion else None, key=f"end_{group_name}")
     event_summary = st.text_area("活動概述", key=f"summary_{group_name}")
     if st.button("建立活動", key=f"add_{group_name}"):
         if event_title and event_date:
+            event_time = f"{start_time:%H:%M}-{end_time:%H:%M}" if start_time and end_time else ""
             add_event_row(
                 group_name,
                 event_title,
                 event_date.strftime("%Y-%m-%d"),
                 user_id,
-                event_summary
+                event_summary,
+                event_time
             )
             st.success("活動已建立")
         else:
@@ -386,11 +685,13 @@ def render_group_events_ui(group_name, user_id):
     for idx, row in events_to_show.iterrows():
         activity_id = row['activity_id']
         st.markdown(f"**活動名稱：{row['event_title']}**")
-        st.markdown(f"活動日期：{row['event_date']}")
+        st.markdown(f"活動日期：{format_event_date(row['event_date'])}")
+        if row.get('event_time'):
+            st.markdown(f"活動時間：{row['event_time']}")
         st.markdown(f"主辦人：{row['created_by']}")
         st.markdown(f"活動說明：{row['event_summary']}")
-        yes_list = [x for x in str(row['participants_yes']).split(",") if x]
-        no_list = [x for x in str(row['participants_no']).split(",") if x]
+        yes_list = row['participants_yes']
+        no_list = row['participants_no']
         is_owner = (row['created_by'] == user_id)
 
         # 主辦人可取消活動與下載名單
@@ -409,41 +710,18 @@ def render_group_events_ui(group_name, user_id):
 
                 st.download_button("下載CSV", df_download.to_csv(index=False).encode("utf-8"), file_name=f"{group_name}_{row['event_title']}_名單.csv")
 
-        # 只有沒選過的人才能選
-        if user_id not in yes_list and user_id not in no_list:
-            c1, c2 = st.columns(2)
-            with c1:
-                if st.button("參加", key=f"join_{activity_id}"):
-                    yes_list.append(user_id)
-                    update_event_participation_by_id(activity_id, yes_list, no_list)
-                    st.success("已標記參加")
-                    
-            with c2:
-                if st.button("不參加", key=f"notjoin_{activity_id}"):
-                    no_list.append(user_id)
-                    update_event_participation_by_id(activity_id, yes_list, no_list)
-                    st.success("已標記不參加")
-                    
-        elif user_id in yes_list:
-            st.info("你已選擇參加")
-            if st.button("取消參加", key=f"leave_yes_{activity_id}"):
-                yes_list.remove(user_id)
-                update_event_participation_by_id(activity_id, yes_list, no_list)
-                st.success("已取消參加")
-                
-        elif user_id in no_list:
-            st.info("你已選擇不參加")
-            if st.button("重新選擇", key=f"leave_no_{activity_id}"):
-                no_list.remove(user_id)
-                update_event_participation_by_id(activity_id, yes_list, no_list)
-                st.success("已取消不參加")
-                
-
-        # 展示名單
-        st.write("目前參加名單")
-        st.write("參加：", yes_list if yes_list else "尚無人參加")
-        st.write("不參加：", no_list if no_list else "尚無人標記不參加")
+        render_event_rsvp(activity_id, user_id)
         st.markdown("---")
+
+    # 歷史活動（已過期或已歸檔，僅供查看）
+    with st.expander("歷史活動"):
+        past_events = get_past_event_rows(group_name)
+        if past_events.empty:
+            st.info("尚無歷史活動")
+        for _, row in past_events.iterrows():
+            yes_count, _ = event_counts(row)
+            st.markdown(f"**{row['event_title']}**（{format_event_date(row['event_date'])}，主辦人：{row['created_by']}，參加 {yes_count} 人）")
+
 def ensure_group_columns(df):
     if 'groups' not in df.columns:
         df['groups'] = ''
@@ -467,140 +745,105 @@ def parse_group_members(members_str):
 def to_group_members_str(group_map):
     return ''.join(f'|{g}:{",".join(sorted(mems))}' for g, mems in group_map.items() if mems)
 
+# 更新單一使用者列的 groups 與 group_members 欄位
+def set_group_membership(df, idx, user_id, group_name, joined):
+    group_set = set(split_list(df.at[idx, "groups"]))
+    group_map = parse_group_members(df.at[idx, "group_members"])
+    if joined:
+        group_set.add(group_name)
+        group_map.setdefault(group_name, set()).add(user_id)
+    else:
+        group_set.discard(group_name)
+        if group_name in group_map:
+            group_map[group_name].discard(user_id)
+            if not group_map[group_name]:
+                del group_map[group_name]
+    df.at[idx, "groups"] = join_list(group_set)
+    df.at[idx, "group_members"] = to_group_members_str(group_map)
+
 def create_group(user_id, group_name):
-    df = get_df()
-    df = ensure_group_columns(df)
-
-    # 檢查群組名稱是否已存在
-    existing_groups = set()
-    for g in df["groups"].dropna():
-        existing_groups.update(g.split(","))
-    if group_name in existing_groups:
-        return False, "該群組名稱已存在"
-
-    # 為用戶新增群組到 groups 與 group_members
-    for i in df.index:
-        if df.at[i, "user_id"] == user_id:
-            # 更新 groups
-            groups = df.at[i, "groups"]
-            group_set = set(groups.split(",")) if groups else set()
-            group_set.add(group_name)
-            df.at[i, "groups"] = ",".join(sorted(group_set))
-            # 更新 group_members
-            group_map = parse_group_members(df.at[i, "group_members"])
-            group_map.setdefault(group_name, set()).add(user_id)
-            df.at[i, "group_members"] = to_group_members_str(group_map)
-            break
-
-    save_df(df)
-    return True, "建立群組成功"
+    def apply(ws):
+        df = ensure_group_columns(ws.df)
 
-def invite_friend_to_group(current_user, friend_id, group_name):
-    df = get_df()
-    df = ensure_group_columns(df)
+        # 檢查群組名稱是否已存在
+        if get_group_index().exists(group_name) or not ws.claim("group", group_name):
+            return False, "該群組名稱已存在"
 
+        # 為用戶新增群組到 groups 與 group_members
+        idx = find_user_label(df, user_id)
+        if idx is not None:
+            ws.touch([idx])
+            set_group_membership(df, idx, user_id, group_name, True)
+        return True, "建立群組成功"
+    return submit_mutation(apply)
+
+def invite_friend_to_group(current_user, friend_id, group_name):
     # 不能邀請自己
     if current_user == friend_id:
         return False, "不能邀請自己加入群組"
 
-    # 檢查使用者是否存在
-    friend_row = df[df["user_id"] == friend_id]
-    if friend_row.empty:
-        return False, "該使用者不存在"
-
-    # 檢查是否為好友
-    current_row = df[df["user_id"] == current_user]
-    if current_row.empty:
-        return False, "當前使用者不存在"
-    current_friends_raw = current_row["friends"].values[0]
-    current_friends = set(current_friends_raw.split(",")) if current_friends_raw else set()
-    if friend_id not in current_friends:
-        return False, "只能邀請好友加入群組"
-
-    # 檢查對方是否已在群組中
-    group_map = parse_group_members(friend_row["group_members"].values[0])
-    if group_name in group_map and friend_id in group_map[group_name]:
-        return False, "對方已經在該群組中"
-
-    # 更新 groups 欄
-    idx = friend_row.index[0]
-    groups = df.at[idx, "groups"]
-    group_set = set(groups.split(",")) if groups else set()
-    group_set.add(group_name)
-    df.at[idx, "groups"] = ",".join(sorted(group_set))
-
-    # 更新 group_members 欄
-    group_map = parse_group_members(df.at[idx, "group_members"])
-    group_map.setdefault(group_name, set()).add(friend_id)
-    df.at[idx, "group_members"] = to_group_members_str(group_map)
+    def apply(ws):
+        df = ensure_group_columns(ws.df)
 
-    save_df(df)
-    return True, "邀請成功，好友已加入群組"
+        # 檢查使用者是否存在
+        idx = find_user_label(df, friend_id)
+        if idx is None:
+            return False, "該使用者不存在"
 
-def list_groups_for_user(user_id):
-    df = get_df()
-    df = ensure_group_columns(df)
-    idx = df[df['user_id'] == user_id].index[0]
-    user_groups = set(df.at[idx, 'groups'].split(',')) if df.at[idx, 'groups'] else set()
-    group_members_map = {g: [] for g in user_groups}
-    for _, row in df.iterrows():
-        row_groups = set(row['groups'].split(',')) if row['groups'] else set()
-        for g in user_groups:
-            if g in row_groups:
-                group_members_map[g].append(row['user_id'])
-    return group_members_map
+        # 檢查是否為好友
+        current_idx = find_user_label(df, current_user)
+        if current_idx is None:
+            return False, "當前使用者不存在"
+        ws.touch([idx])
+        if friend_id not in split_list(df.at[current_idx, "friends"]):
+            return False, "只能邀請好友加入群組"
+        if group_name not in split_list(df.at[current_idx, "groups"]):
+            return False, "您不在該群組中"
 
-def remove_member_from_group(user_id, group_name, target_id):
-    df = get_df()
-    df = ensure_group_columns(df)
+        # 檢查對方是否已在群組中
+        if group_name in split_list(df.at[idx, "groups"]):
+            return False, "對方已經在該群組中"
 
-    if target_id not in df['user_id'].values:
-        return False, "成員不存在"
+        set_group_membership(df, idx, friend_id, group_name, True)
+        return True, "邀請成功，好友已加入群組"
+    return submit_mutation(apply)
 
-    idx = df[df['user_id'] == target_id].index[0]
+def list_groups_for_user(user_id):
+    index = get_group_index()
+    return {g: index.members_of(g) for g in index.groups_for(user_id)}
 
-    # 1. 移除 groups 欄位的群組
-    group_list = set(df.at[idx, 'groups'].split(',')) if df.at[idx, 'groups'] else set()
-    if group_name in group_list:
-        group_list.remove(group_name)
-        df.at[idx, 'groups'] = ','.join(sorted(group_list))
+def remove_member_from_group(user_id, group_name, target_id):
+    def apply(ws):
+        df = ensure_group_columns(ws.df)
 
-    # 2. 更新 group_members 欄位
-    group_map = parse_group_members(df.at[idx, 'group_members'])
-    if group_name in group_map:
-        group_map[group_name].discard(target_id)
-        if not group_map[group_name]:
-            del group_map[group_name]
-    df.at[idx, 'group_members'] = to_group_members_str(group_map)
+        idx = find_user_label(df, target_id)
+        if idx is None:
+            return False, "成員不存在"
+        ws.touch([idx])
 
-    save_df(df)
-    return True, f"{target_id} 已從群組 {group_name} 中移除"
+        set_group_membership(df, idx, target_id, group_name, False)
+        return True, f"{target_id} 已從群組 {group_name} 中移除"
+    return submit_mutation(apply)
 
 def delete_group(group_name):
-    df = get_df()
-    df = ensure_group_columns(df)
-
-    # 1. 先移除所有人的 groups 和 group_members 欄位中的這個群組
-    for idx, row in df.iterrows():
-        # 移除 groups 欄
-        groups = set(row['groups'].split(',')) if row['groups'] else set()
-        if group_name in groups:
-            groups.remove(group_name)
-            df.at[idx, 'groups'] = ','.join(sorted(groups))
-        # 移除 group_members 欄
-        group_map = parse_group_members(row['group_members'])
-        if group_name in group_map:
-            del group_map[group_name]
-        df.at[idx, 'group_members'] = to_group_members_str(group_map)
-    
-    # 2. 刪除群組本身與所有活動（row_type==group 或 event 且 group_name符合）
-    df = df[~(((df['row_type'] == 'group') | (df['row_type'] == 'event')) & (df['group_name'] == group_name))]
+    def apply(ws):
+        df = ensure_group_columns(ws.df)
 
-    save_df(df)
-    return True, f"群組 {group_name} 及其活動已刪除"
+        # 1. 只修改群組成員的 groups 和 group_members 欄位；成員由工作區的最新資料找出，
+        #    不依賴可能落後於同批先前操作的共用索引
+        candidates = df.loc[df['groups'].astype(str).str.contains(group_name, regex=False), 'groups']
+        members = candidates.index[candidates.map(lambda groups: group_name in split_list(groups))]
+        ws.touch(members)
+        for idx in members:
+            set_group_membership(df, idx, df.at[idx, 'user_id'], group_name, False)
 
+        # 2. 刪除群組的所有活動
+        ws.drop(ws.events.index[ws.events['group_name'].astype(str) == group_name], table="events")
+        return True, f"群組 {group_name} 及其活動已刪除"
+    return submit_mutation(apply)
 
-def show_group_availability(group_map):
+
+def show_group_availability(group_map, days=30, top_k=5):
     st.subheader("群組成員空閒時間")
     if not group_map:
         st.info("你目前沒有加入任何群組")
@@ -611,13 +854,25 @@ def show_group_availability(group_map):
     if not members:
         st.info("這個群組尚無其他成員")
         return
-    selected_user = st.selectbox("選擇要查看的成員", members, key=f"user_selector_{selected_group}")
-    if st.session_state.get("last_calendar_group") != selected_group or st.session_state.get("last_calendar_user") != selected_user:
-        for suffix in ["show_year", "show_month", "last_click"]:
-            st.session_state.pop(f"{selected_user}_{suffix}", None)
-        st.session_state["last_calendar_group"] = selected_group
-        st.session_state["last_calendar_user"] = selected_user
-    display_calendar_view(selected_user)
+
+    # 整個群組的重疊一次以矩陣運算取得
+    matrix = get_availability_matrix()
+    first = date.today()
+    sub = matrix.rows(members, first, days)
+    labels = matrix.date_labels(first, days)
+    render_availability_heatmap(members, labels, sub, "成員 × 日期")
+
+    best = matrix.top_dates(members, first, days, k=top_k)
+    if best:
+        st.markdown("**最多人有空的日期**")
+        for d, count in best:
+            st.markdown(f"- {d}：{count}/{len(members)} 人有空")
+    else:
+        st.info("未來這段期間沒有成員登記空閒")
+
+    common = get_slot_index().longest_common_window(members, after=datetime.now())
+    if common:
+        st.markdown(f"**全員都有空的最長時段**：{common[0]:%Y-%m-%d %H:%M} ～ {common[1]:%m-%d %H:%M}")
 
 def render_group_management_ui(user_id):
     st.subheader("所屬群組與成員")
@@ -629,23 +884,34 @@ def render_group_management_ui(user_id):
             st.markdown(f"#### {gname}")
             st.markdown(f"成員：{', '.join(members)}")
 
+    show_group_availability(groups)
+
     st.markdown("---")
     st.subheader("建立新群組")
     new_group = st.text_input("群組名稱", key="new_group_input")
+    initial_invites = st.multiselect("同時邀請好友", list_friends(user_id), key="new_group_invites")
     if st.button("建立群組"):
-        success, msg = create_group(user_id, new_group)
+        # 建立群組與邀請好友在同一筆交易中一次寫回
+        with transaction() as tx:
+            created, _ = create_group(user_id, new_group)
+            if created:
+                for friend in initial_invites:
+                    invite_friend_to_group(user_id, friend, new_group)
+        (success, msg), *invites = tx.results
         if success:
             st.success(msg)
+            for friend, (ok, invite_msg) in zip(initial_invites, invites):
+                st.success(f"{friend}：{invite_msg}") if ok else st.error(f"{friend}：{invite_msg}")
         else:
             st.error(msg)
 
     st.subheader("邀請好友加入群組")
-    friend_to_invite = st.text_input("好友 ID", key="friend_invite_input")
+    friend_to_invite = user_search_picker("好友 ID", "friend_invite", user_id)
 
     group_choices = list(groups.keys()) if groups else []
     if group_choices:
         group_target = st.selectbox("選擇要加入的群組", group_choices, key="group_invite_target")
-        if st.button("邀請好友"):
+        if st.button("邀請好友", disabled=friend_to_invite is None):
             success, msg = invite_friend_to_group(user_id, friend_to_invite, group_target)
             st.success(msg) if success else st.error(msg)
     else:
@@ -688,73 +954,91 @@ def render_group_management_ui(user_id):
         with st.expander(f"【{gname}】活動／日程表"):
             render_group_events_ui(gname, user_id)
 
-def get_df():
-    records = sheet.get_all_records()
-    df = pd.DataFrame(records)
-    if df.empty:
-        df = pd.DataFrame(columns=['row_type', 'user_id', 'password', 'available_dates', 'friends', 'friend_requests', 'groups', 'group_members', 'group_name', 'event_title', 'event_date', 'created_by', 'participants_yes', 'participants_no'])
+# 在伺服器端篩選並分頁，只把目前這一頁送到瀏覽器
+def admin_table_page(table, row_type=None, group="", day=None, page=1, page_size=ADMIN_PAGE_SIZE):
+    df = get_df(table)
+    day_str = day.strftime("%Y-%m-%d") if day else ""
+    if table == "records":
+        if row_type is not None:
+            df = df[df["row_type"].astype(str) == row_type]
+        if group:
+            df = df[df["user_id"].isin(get_group_index().members_of(group))]
+        if day_str:
+            df = df[df["user_id"].isin(get_availability_index().users_on(day_str))]
     else:
-        # 確保所有欄位齊全
-        for col in ['row_type', 'user_id', 'password', 'available_dates', 'friends', 'friend_requests', 'groups', 'group_members', 'group_name', 'event_title', 'event_date', 'created_by', 'participants_yes', 'participants_no']:
-            if col not in df.columns:
-                df[col] = ''
-        df = df.fillna("")
-    return df
-
-def save_df(df, cooldown=2.0):
-    # 強制所有日期欄位為字串
-    for col in df.columns:
-        if df[col].dtype == 'datetime64[ns]' or df[col].dtype == 'datetime64[ns, UTC]':
-            df[col] = df[col].dt.strftime('%Y-%m-%d')
-        elif df[col].apply(lambda x: isinstance(x, (pd.Timestamp, datetime, date))).any():
-            df[col] = df[col].apply(lambda x: x.strftime('%Y-%m-%d') if isinstance(x, (pd.Timestamp, datetime, date)) else x)
-
-    now = time.time()
-    if now - st.session_state.get("last_save_timestamp", 0) < cooldown:
-        st.warning("操作太頻繁，請稍候再試")
-        return False
-    df = df.fillna("")
-    sheet.clear()
-    sheet.update([df.columns.values.tolist()] + df.values.tolist())
-    st.session_state.last_save_timestamp = now
-    return True
-
-
-# 活動資料操作輔助
-def get_event_rows(group_name=None):
-    df = get_df()
-    events = df[df['row_type'] == 'event']
-    if group_name is not None:
-        events = events[events['group_name'] == group_name]
-    return events
-
-def add_event_row(group_name, event_title, event_date, created_by, event_summary):
-    df = get_df()
-    # 建議補欄位兼容
-    for col in ["group_name", "event_title", "event_date", "created_by", "event_summary", "participants_yes", "participants_no"]:
-        if col not in df.columns:
-            df[col] = ""
-    new_row = {
-        "row_type": "event",    
-        "group_name": group_name,
-        "event_title": event_title,
-        "event_date": event_date,
-        "created_by": created_by,
-        "event_summary": event_summary,
-        "participants_yes": "",
-        "participants_no": ""
-    }
-    df = pd.concat([df, pd.DataFrame([new_row])], ignore_index=True)
-    save_df(df)
-
+        # 以型別化檢視比對（event_date 為日期型別），再取出對應的原始列
+        typed = get_typed_df(table)
+        mask = pd.Series(True, index=typed.index)
+        if group:
+            mask &= typed["group_name"] == group
+        if day:
+            mask &= typed["event_date"] == pd.Timestamp(day)
+        df = df[df.index.isin(typed.index[mask.to_numpy()])]
+    start = (page - 1) * page_size
+    return df.iloc[start:start + page_size], len(df)
+
+def render_admin_table():
+    tables = {"使用者": "records", "活動": "events", "已歸檔活動": "events_archive"}
+    table = tables[st.radio("資料表", list(tables), horizontal=True, key="admin_table")]
+    c1, c2, c3 = st.columns(3)
+    row_type = None
+    if table == "records":
+        row_types = sorted(get_df()["row_type"].astype(str).unique())
+        picked = c1.selectbox("row_type", ["全部"] + row_types, key="admin_row_type")
+        row_type = None if picked == "全部" else picked
+    group = c2.text_input("群組", key="admin_group").strip()
+    day = c3.date_input("日期", value=None, key="admin_day")
+    page = st.number_input("頁數", min_value=1, value=1, step=1, key="admin_page")
+    rows, total = admin_table_page(table, row_type, group, day, page)
+    st.caption(f"共 {total} 筆，第 {page} / {max(1, -(-total // ADMIN_PAGE_SIZE))} 頁")
+    st.dataframe(rows)
+
+# 切換開關本身也會觸發一次重新執行，略過這一次，分析的是之後的那一次
+def arm_profiler():
+    st.session_state.profile_skip_once = st.session_state.profile_next_rerun
+
+def render_profiling_panel():
+    st.subheader("效能監控")
+    timers = timer_rows()
+    rerun = next((row for row in timers if row["項目"] == "rerun"), None)
+    if rerun:
+        c1, c2, c3 = st.columns(3)
+        c1.metric("重新執行 p50 (ms)", rerun["p50(ms)"])
+        c2.metric("p95 (ms)", rerun["p95(ms)"])
+        c3.metric("p99 (ms)", rerun["p99(ms)"])
+    st.markdown("**耗時**")
+    st.dataframe(pd.DataFrame(timers), width="stretch")
+    st.markdown("**API 呼叫與傳輸量**")
+    st.dataframe(pd.DataFrame(counter_rows()), width="stretch")
+    if st.button("重設統計"):
+        reset_metrics()
+        st.rerun()
+    st.toggle("以 cProfile 分析下一次重新執行", key="profile_next_rerun", on_change=arm_profiler)
+    if "last_profile" in st.session_state:
+        with st.expander("最近一次 cProfile 報告"):
+            st.code(st.session_state.last_profile)
+
+# 使用者表與活動表的版本標記，閒置時每次檢查只讀一次後端
+def data_version():
+    return get_versions(("records", "events"))
+
+# 片段內自己寫入後記下新版本，避免版本監看再觸發整頁重新執行
+def remember_data_version():
+    st.session_state.data_version = data_version()
+
+# 定時只比對版本標記，資料真的有變動時才重新執行整頁
+@st.fragment(run_every=REFRESH_CHECK_INTERVAL)
+def watch_data_version():
+    version = data_version()
+    if st.session_state.get("data_version") != version:
+        st.session_state.data_version = version
+        st.rerun(scope="app")
 
-def update_event_participation(event_idx, yes_list, no_list):
-    df = get_df()
-    df.at[event_idx, "participants_yes"] = ",".join(yes_list)
-    df.at[event_idx, "participants_no"] = ",".join(no_list)
-    save_df(df)
 def render_ui():
     st.title("NO_JO")
+    migrate_event_rows()
+    start_event_sweeper()
+    start_index_warmer()
 
     if "authenticated" not in st.session_state:
         st.session_state.authenticated = False
@@ -786,100 +1070,138 @@ def render_ui():
     selected_page = st.sidebar.radio("功能選單", page_options)
     st.session_state.page = selected_page
 
-    if selected_page == "註冊":
-        uid = st.text_input("新帳號")
-        pw = st.text_input("密碼", type="password")
-        if st.button("註冊"):
-            #from auth import register_user
-            success, msg = register_user(uid, pw)
-            if success:
-                st.success(msg)
-                st.session_state.page = "登入"
-            else:
-                st.error(msg)
+    # 各頁面分支的耗時分開記錄
+    with timer(f"page:{selected_page}"):
+        if selected_page == "註冊":
+            uid = st.text_input("新帳號")
+            pw = st.text_input("密碼", type="password")
+            if st.button("註冊"):
+                #from auth import register_user
+                success, msg = register_user(uid, pw)
+                if success:
+                    st.success(msg)
+                    st.session_state.page = "登入"
+                else:
+                    st.error(msg)
 
-    elif selected_page == "登入":
-        uid = st.text_input("帳號")
-        pw = st.text_input("密碼", type="password")
-        if st.button("登入"):
-           #from auth import authenticate_user
-            if authenticate_user(uid, pw):
-                st.session_state.authenticated = True
-                st.session_state.user_id = uid
-                st.success("登入成功")
-                st.session_state.page = "登入成功"
-                st.session_state.rerun_triggered = False
-                st.rerun()
+        elif selected_page == "登入":
+            uid = st.text_input("帳號")
+            pw = st.text_input("密碼", type="password")
+            if st.button("登入"):
+               #from auth import authenticate_user
+                if authenticate_user(uid, pw):
+                    st.session_state.authenticated = True
+                    st.session_state.user_id = uid
+                    st.success("登入成功")
+                    st.session_state.page = "登入成功"
+                    st.session_state.rerun_triggered = False
+                    st.rerun()
+                else:
+                    st.error("帳號或密碼錯誤")
+
+        elif selected_page == "登記可用時間":
+            render_availability_form(st.session_state.user_id)
+
+        elif selected_page == "查詢可配對使用者":
+            st.header("最佳配對")
+            matches = top_matches(st.session_state.user_id)
+            if matches is None:
+                st.info("配對排行計算中，請稍後重新整理")
+            elif matches:
+                st.dataframe(pd.DataFrame([{"使用者": u, "重疊度": f"{score:.0%}", "共同空閒天數": common} for u, score, common in matches]), hide_index=True)
             else:
-                st.error("帳號或密碼錯誤")
-
-    elif selected_page == "登記可用時間":
-        date_range = pd.date_range(date.today(), periods=30).tolist()
-        selected = st.multiselect("選擇可用日期", date_range, format_func=lambda d: d.strftime("%Y-%m-%d"))
-        if st.button("更新"):
-            update_availability(st.session_state.user_id, [d.strftime("%Y-%m-%d") for d in selected])
-
-    elif selected_page == "查詢可配對使用者":
-        df = get_df()
-        st.header("查詢使用者空閒日曆")
-        other_users = df[df["user_id"] != st.session_state.user_id]["user_id"].tolist()
-        target = st.selectbox("選擇使用者", other_users)
-        display_calendar_view(target)
-        date_range = pd.date_range(date.today(), periods=30).tolist()
-        selected = st.multiselect("查詢日期", date_range, format_func=lambda d: d.strftime("%Y-%m-%d"))
-        for d in selected:
-            users = find_users_by_date(d.strftime("%Y-%m-%d"), st.session_state.user_id)
-            st.write(f"{d.strftime('%Y-%m-%d')}: {', '.join(users) if users else '無'}")
-
-    elif selected_page == "送出好友申請":
-        target = st.text_input("輸入對方 ID")
-        if st.button("送出好友申請"):
-            msg = send_friend_request(st.session_state.user_id, target)
-            st.info(msg)
-
-    elif selected_page == "回應好友申請":
-        requests = list_friend_requests(st.session_state.user_id)
-        if not requests:
-            st.info("目前沒有好友申請")
-        else:
-            for requester in requests:
+                st.info("登記可用時間後即可看到與你最常同時有空的使用者")
+
+            st.header("查詢使用者空閒日曆")
+            target = user_search_picker("選擇使用者", "calendar_target", st.session_state.user_id)
+            if target:
+                display_calendar_view(target)
+            date_range = pd.date_range(date.today(), periods=30).tolist()
+            mode = st.radio("查詢方式", ["逐日列出", "所有日期皆有空", "任一日期有空", "日期區間", "時段"], horizontal=True)
+            if mode == "時段":
+                slot_day = st.date_input("日期", value=date.today(), key="slot_query_day")
+                c1, c2 = st.columns(2)
+                slot_start = c1.time_input("開始", value=datetime.strptime("19:00", "%H:%M").time(), key="slot_query_start")
+                slot_end = c2.time_input("結束", value=datetime.strptime("21:00", "%H:%M").time(), key="slot_query_end")
+                start = datetime.combine(slot_day, slot_start)
+                end = datetime.combine(slot_day, slot_end)
+                if end <= start:
+                    end += timedelta(days=1)
+                users = find_users_in_slot(start, end, st.session_state.user_id)
+                st.write(f"{start:%Y-%m-%d %H:%M} ~ {end:%H:%M}: {', '.join(users) if users else '無'}")
+            elif mode == "日期區間":
+                picked = st.date_input("查詢區間", value=(date.today(), date.today() + timedelta(days=6)))
+                if len(picked) == 2:
+                    start, end = picked[0].strftime("%Y-%m-%d"), picked[1].strftime("%Y-%m-%d")
+                    users = find_users_in_range(start, end, st.session_state.user_id)
+                    st.write(f"{start} ~ {end}: {', '.join(users) if users else '無'}")
+            else:
+                selected = st.multiselect("查詢日期", date_range, format_func=lambda d: d.strftime("%Y-%m-%d"))
+                date_strs = [d.strftime("%Y-%m-%d") for d in selected]
+                if mode == "逐日列出":
+                    for d in date_strs:
+                        users = find_users_by_date(d, st.session_state.user_id)
+                        st.write(f"{d}: {', '.join(users) if users else '無'}")
+                elif date_strs:
+                    users = find_users_by_dates(date_strs, st.session_state.user_id, mode="all" if mode == "所有日期皆有空" else "any")
+                    st.write(f"{mode}: {', '.join(users) if users else '無'}")
+
+        elif selected_page == "送出好友申請":
+            target = user_search_picker("輸入對方 ID", "friend_request", st.session_state.user_id)
+            if st.button("送出好友申請", disabled=target is None):
+                msg = send_friend_request(st.session_state.user_id, target)
+                st.info(msg)
+
+            st.subheader("推薦好友")
+            suggestions = suggest_friends(st.session_state.user_id)
+            if not suggestions:
+                st.info("目前沒有推薦的好友")
+            for candidate, mutual in suggestions:
                 col1, col2 = st.columns([2, 1])
                 with col1:
-                    st.write(f"來自 {requester} 的好友申請")
+                    st.write(f"{candidate}（{mutual} 位共同好友）")
                 with col2:
-                    if st.button("接受", key=f"accept_{requester}"):
-                        msg = accept_friend_request(st.session_state.user_id, requester)
-                        st.success(msg)
-                        st.rerun()
-                    if st.button("拒絕", key=f"reject_{requester}"):
-                        msg = reject_friend_request(st.session_state.user_id, requester)
-                        st.info(msg)
-                        st.rerun()
-
-    elif selected_page == "查看好友清單":
-        show_friend_list_with_availability(st.session_state.user_id)
-
-    elif selected_page == "群組管理":
-        render_group_management_ui(st.session_state.user_id)
-
-    elif selected_page == "管理介面" and st.session_state.user_id == "GM":
-        st.subheader("GM 管理介面")
-        df = get_df()
-        st.dataframe(df)
+                    if st.button("加好友", key=f"suggest_{candidate}"):
+                        st.info(send_friend_request(st.session_state.user_id, candidate))
+
+        elif selected_page == "回應好友申請":
+            render_friend_requests(st.session_state.user_id)
+
+        elif selected_page == "查看好友清單":
+            show_friend_list_with_availability(st.session_state.user_id)
+
+        elif selected_page == "群組管理":
+            render_group_management_ui(st.session_state.user_id)
+
+        elif selected_page == "管理介面" and st.session_state.user_id == "GM":
+            st.subheader("GM 管理介面")
+            depth = quota_queue_depth()
+            st.caption(f"Sheets API 排隊中：讀取 {depth['read']}、寫入 {depth['write']}")
+            render_admin_table()
+            render_profiling_panel()
         
-    elif selected_page == "登出":
-        st.session_state.authenticated = False
-        st.session_state.user_id = ""
-        st.session_state.page = "登入"
-        st.success("已登出")
-        st.rerun()
-  # 每 60 秒自動刷新頁面
-if "last_refresh_time" not in st.session_state:
-    st.session_state.last_refresh_time = time.time()
-elif time.time() - st.session_state.last_refresh_time > 60:
-    st.session_state.last_refresh_time = time.time()
-    st.rerun()
-
-# 主畫面邏輯
-#from ui_module import render_ui
-render_ui()
+        elif selected_page == "登出":
+            st.session_state.authenticated = False
+            st.session_state.user_id = ""
+            st.session_state.page = "登入"
+            st.success("已登出")
+            st.rerun()
+
+# 以 streamlit run 執行時才啟動畫面；被 import（例如基準測試）時只載入函式
+if __name__ == "__main__":
+    # 主畫面邏輯；每次重新執行都計時，GM 開啟分析時以 cProfile 記錄這一次
+    #from ui_module import render_ui
+    # 在畫面讀取資料之前記下版本：畫面執行期間其他人寫入時，版本監看仍會發現並重新執行；
+    # 自己在片段回呼中的寫入由回呼記下寫入後的版本
+    version = data_version()
+    with timer("rerun"):
+        if st.session_state.get("profile_next_rerun") and st.session_state.get("user_id") == "GM" and not st.session_state.get("profile_skip_once"):
+            st.session_state.profile_next_rerun = False
+            with profiled(st.session_state):
+                render_ui()
+        else:
+            st.session_state.profile_skip_once = False
+            render_ui()
+
+    st.session_state.data_version = version
+    watch_data_version()
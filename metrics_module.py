@@ -0,0 +1,103 @@
+import cProfile
+import io
+import pstats
+import threading
+import time
+import numpy as np
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from functools import wraps
+
+SAMPLE_SIZE = 1000  # 每個計時項目保留最近幾筆耗時，用來算百分位數
+PROFILE_LIMIT = 40  # cProfile 報告列出的函式數
+
+
+# 全程序共用的計數器與耗時紀錄（所有 session 共享）
+class Metrics:
+    def __init__(self, sample_size=SAMPLE_SIZE):
+        self.lock = threading.Lock()
+        self.sample_size = sample_size
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.counters = defaultdict(int)
+            self.calls = defaultdict(int)
+            self.totals = defaultdict(float)
+            self.samples = defaultdict(lambda: deque(maxlen=self.sample_size))
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] += n
+
+    def observe(self, name, seconds):
+        with self.lock:
+            self.calls[name] += 1
+            self.totals[name] += seconds
+            self.samples[name].append(seconds)
+
+    def counter_rows(self):
+        with self.lock:
+            return [{"項目": name, "數量": value} for name, value in sorted(self.counters.items())]
+
+    def timer_rows(self):
+        with self.lock:
+            items = [(name, self.calls[name], self.totals[name], list(samples)) for name, samples in self.samples.items()]
+        rows = []
+        for name, calls, total, samples in sorted(items):
+            p50, p95, p99 = np.percentile(samples, [50, 95, 99]) * 1000
+            rows.append({
+                "項目": name,
+                "次數": calls,
+                "總耗時(ms)": round(total * 1000, 1),
+                "p50(ms)": round(p50, 1),
+                "p95(ms)": round(p95, 1),
+                "p99(ms)": round(p99, 1),
+            })
+        return rows
+
+
+_metrics = Metrics()
+
+def count(name, n=1):
+    _metrics.count(name, n)
+
+# 計時區塊；例外（包含 st.rerun 的控制流程）也會記錄
+@contextmanager
+def timer(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _metrics.observe(name, time.perf_counter() - start)
+
+def instrument(name):
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            with timer(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def counter_rows():
+    return _metrics.counter_rows()
+
+def timer_rows():
+    return _metrics.timer_rows()
+
+def reset_metrics():
+    _metrics.reset()
+
+# 以 cProfile 記錄區塊內的執行，結束時把依累計時間排序的報告存進 sink[key]
+@contextmanager
+def profiled(sink, key="last_profile", limit=PROFILE_LIMIT):
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        out = io.StringIO()
+        pstats.Stats(profiler, stream=out).sort_stats("cumulative").print_stats(limit)
+        sink[key] = out.getvalue()
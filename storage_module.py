@@ -0,0 +1,1135 @@
+import os
+import time
+import logging
+import uuid
+import heapq
+import queue
+import random
+import sqlite3
+import itertools
+import threading
+import numpy as np
+import pandas as pd
+import streamlit as st
+import gspread
+import requests
+from abc import ABC, abstractmethod
+from concurrent.futures import Future
+from contextlib import contextmanager
+from datetime import datetime, date
+from gspread.cell import Cell
+from gspread.utils import rowcol_to_a1, a1_to_rowcol, numericise_all
+from google.oauth2 import service_account
+from google.auth.transport.requests import Request
+from metrics_module import count, instrument
+
+SHEET_NAME = "meeting_records"
+META_SHEET_NAME = "_meta"
+VERSION_CHECK_INTERVAL = 5.0  # 秒，兩次檢查版本標記的最短間隔
+COALESCE_WINDOW = 0.1  # 秒，寫入佇列合併同批操作的等待時間
+MUTATION_TIMEOUT = 30.0
+RETRY_ATTEMPTS = 5  # Sheets API 暫時性錯誤的最多嘗試次數
+RETRY_BASE_DELAY = 0.5  # 秒，指數退避的起始等待
+RETRY_MAX_DELAY = 16.0  # 秒，單次等待上限
+RETRY_STATUS = {429, 500, 502, 503, 504}
+SHEETS_QUOTA_PER_MINUTE = {"read": 60, "write": 60}  # Sheets API 每分鐘讀／寫請求配額
+SHEETS_QUOTA_BURST = 10  # 權杖桶容量，避免瞬間用光整分鐘的配額
+PRIORITY_WRITE, PRIORITY_READ, PRIORITY_BACKGROUND = 0, 1, 2
+WRITE_METHODS = {"batch_update", "update", "update_acell", "update_cells", "clear", "add_rows", "add_cols", "add_worksheet", "append_row", "append_rows", "delete_rows", "resize"}
+DEFAULT_COLUMNS = ['row_type', 'user_id', 'password', 'available_dates', 'available_slots', 'friends', 'friend_requests', 'groups', 'group_members', 'group_name', 'event_title', 'event_date', 'created_by', 'participants_yes', 'participants_no']
+EVENT_COLUMNS = ['activity_id', 'group_name', 'event_title', 'event_date', 'event_time', 'created_by', 'event_summary', 'participants_yes', 'participants_no', 'yes_count', 'no_count']
+# 型別化檢視的欄位型別：讀入後解析一次，之後讀取端直接使用
+CATEGORY_COLUMNS = ['row_type', 'user_id', 'group_name', 'created_by']
+DATE_COLUMNS = ['event_date']
+LIST_COLUMNS = ['available_dates', 'available_slots', 'friends', 'friend_requests', 'groups', 'participants_yes', 'participants_no']
+INT_COLUMNS = ['yes_count', 'no_count']
+# 各資料表的欄位與版本標記所在儲存格；records 為原本的第一個工作表
+TABLES = {
+    "records": {"columns": DEFAULT_COLUMNS, "version_cell": "A1"},
+    "events": {"columns": EVENT_COLUMNS, "version_cell": "B1"},
+    "events_archive": {"columns": EVENT_COLUMNS + ['archived_at'], "version_cell": "C1"},
+}
+VERSION_RANGE = "A1:C1"  # _meta 工作表中所有資料表的版本標記，一次讀取
+# 同一批次的寫回順序：資料在表之間搬移（使用者表→活動表、活動表→歸檔表）時先寫入接收的一方，
+# 中途失敗最多留下重複的列，不會遺失
+SAVE_ORDER = ["events_archive", "events", "records"]
+
+
+def records_to_df(records, columns=DEFAULT_COLUMNS):
+    df = pd.DataFrame(records)
+    if df.empty:
+        df = pd.DataFrame(columns=columns)
+    else:
+        # 確保所有欄位齊全
+        for col in columns:
+            if col not in df.columns:
+                df[col] = ''
+        df = df.fillna("")
+    return df
+
+def split_list(raw):
+    return [x.strip() for x in raw.split(',') if x.strip()] if isinstance(raw, str) else []
+
+def join_list(items):
+    return ','.join(sorted(items))
+
+# 儲存格內容轉成型別化的欄位：鍵值為 categorical、日期為 datetime64、名單預先切成 list
+def to_typed(df):
+    typed = df.copy()
+    for col in df.columns:
+        raw = df[col].astype(str)
+        if col in CATEGORY_COLUMNS:
+            typed[col] = raw.astype("category")
+        elif col in DATE_COLUMNS:
+            typed[col] = pd.to_datetime(raw, format="%Y-%m-%d", errors="coerce")
+        elif col in LIST_COLUMNS:
+            typed[col] = raw.map(split_list)
+        elif col in INT_COLUMNS:
+            typed[col] = pd.to_numeric(df[col], errors="coerce").astype("Int64")
+    return typed
+
+# 寫入後套用索引差異用：只有少數幾列，逐格轉換省去 to_typed 每欄的 pandas 開銷；
+# 值與 to_typed 相同，只是鍵值欄維持字串而不是 categorical
+def to_typed_rows(df):
+    data = {}
+    for col, values in zip(df.columns, df.to_numpy(dtype=object).T.tolist()):
+        if col in CATEGORY_COLUMNS:
+            data[col] = [str(v) for v in values]
+        elif col in DATE_COLUMNS:
+            data[col] = [parse_cell_date(str(v)) for v in values]
+        elif col in LIST_COLUMNS:
+            data[col] = [split_list(str(v)) for v in values]
+        elif col in INT_COLUMNS:
+            data[col] = [parse_cell_int(v) for v in values]
+        else:
+            data[col] = values
+    return pd.DataFrame(data, index=df.index, columns=df.columns, dtype=object)
+
+def parse_cell_date(raw):
+    try:
+        return pd.Timestamp(datetime.strptime(raw, "%Y-%m-%d"))
+    except ValueError:
+        return pd.NaT
+
+def parse_cell_int(raw):
+    try:
+        number = float(raw)
+    except (TypeError, ValueError):
+        return pd.NA
+    return int(number) if number.is_integer() else pd.NA
+
+def serialize_value(value):
+    if isinstance(value, (pd.Timestamp, datetime, date)):
+        return value.strftime('%Y-%m-%d')
+    if isinstance(value, (list, tuple, set)):
+        return join_list(value)
+    return value
+
+# 把單一欄位轉回儲存格字串；純字串欄位直接沿用，只有混雜型別時才逐格轉換
+def serialize_column(col):
+    if isinstance(col.dtype, pd.CategoricalDtype):
+        return col.astype(str).where(col.notna(), "")
+    if pd.api.types.is_datetime64_any_dtype(col):
+        return col.dt.strftime('%Y-%m-%d').fillna("")
+    if pd.api.types.is_extension_array_dtype(col):
+        return col.astype(object).where(col.notna(), "")
+    if col.dtype != object:
+        return col
+    kind = pd.api.types.infer_dtype(col, skipna=True)
+    if kind in ("string", "empty", "integer", "floating", "boolean"):
+        return col
+    if kind in ("date", "datetime"):
+        return pd.to_datetime(col).dt.strftime('%Y-%m-%d').fillna("")
+    return col.map(serialize_value)
+
+# 與快照逐欄比對（依 index 對齊），值未變動的欄位不需要再檢查格式
+def changed_columns(snapshot, df):
+    if snapshot is None or not df.index.is_unique or not snapshot.index.is_unique:
+        return list(df.columns)
+    changed = []
+    for col in df.columns:
+        if col not in snapshot.columns or df[col].dtype != snapshot[col].dtype:
+            changed.append(col)
+            continue
+        old = snapshot[col].reindex(df.index).to_numpy()
+        if not (df[col].to_numpy() == old).all():
+            changed.append(col)
+    return changed
+
+def serialize_frame(df, snapshot=None):
+    df = df.copy()
+    for col in changed_columns(snapshot, df):
+        df[col] = serialize_column(df[col])
+    return df.fillna("")
+
+def quote_columns(columns):
+    return ", ".join(f'"{c}"' for c in columns)
+
+def to_grid(df):
+    return [[str(c) for c in df.columns]] + df.astype(str).values.tolist()
+
+# 以 CSV 長度估計傳輸量（效能監控用）
+def frame_bytes(df):
+    return len(df.to_csv(index=False, header=False).encode("utf-8")) if len(df) else 0
+
+# 依 index 對齊快照：保留原列位置，刪除留下的空位由新增列或尾端列補上
+def arrange_rows(snapshot, df):
+    old_pos = {label: pos for pos, label in enumerate(snapshot.index)}
+    total = len(df)
+    layout = [None] * total
+    movers = []
+    for label in df.index:
+        pos = old_pos.get(label)
+        if pos is not None and pos < total:
+            layout[pos] = label
+        elif pos is None:
+            movers.append(label)
+    movers.extend(label for label in snapshot.index if label in df.index and old_pos[label] >= total)
+    movers = iter(movers)
+    layout = [label if label is not None else next(movers) for label in layout]
+    return df.loc[layout].reset_index(drop=True)
+
+# 找出新舊資料中內容不同的列位置（兩者皆已依位置排列）
+def changed_positions(snapshot, df):
+    old = snapshot.reindex(columns=df.columns).fillna("").astype(str).to_numpy()
+    new = df.astype(str).to_numpy()
+    common = min(len(old), len(new))
+    changed = np.flatnonzero((old[:common] != new[:common]).any(axis=1)).tolist()
+    return changed + list(range(common, max(len(old), len(new))))
+
+# 比對新舊表格，只產生有變動儲存格的範圍（每列一段），舊資料多出的部分填空白
+def diff_grid_updates(old_grid, new_grid, new_values):
+    width = max(len(new_grid[0]), len(old_grid[0]) if old_grid else 0)
+    height = max(len(new_grid), len(old_grid))
+    old = np.full((height, width), "", dtype=object)
+    new = np.full((height, width), "", dtype=object)
+    for i, row in enumerate(old_grid):
+        old[i, :len(row)] = row
+    for i, row in enumerate(new_grid):
+        new[i, :len(row)] = row
+    updates = []
+    for i in np.flatnonzero((old != new).any(axis=1)):
+        cols = np.flatnonzero(old[i] != new[i])
+        first, last = cols[0], cols[-1]
+        source = new_values[i] if i < len(new_values) else []
+        values = [source[j] if j < len(source) else "" for j in range(first, last + 1)]
+        updates.append({
+            "range": f"{rowcol_to_a1(i + 1, first + 1)}:{rowcol_to_a1(i + 1, last + 1)}",
+            "values": [values],
+        })
+    return updates
+
+# 單列比對：只寫入該列第一個到最後一個變動儲存格之間的範圍；沒有變動時回傳 None
+def diff_row_update(row_number, old, new, values):
+    width = max(len(old), len(new))
+    cols = [j for j in range(width) if (old[j] if j < len(old) else "") != (new[j] if j < len(new) else "")]
+    if not cols:
+        return None
+    first, last = cols[0], cols[-1]
+    return {
+        "range": f"{rowcol_to_a1(row_number, first + 1)}:{rowcol_to_a1(row_number, last + 1)}",
+        "values": [[values[j] if j < len(values) else "" for j in range(first, last + 1)]],
+    }
+
+def row_strings(df, pos):
+    return [str(v) for v in df.iloc[pos].tolist()] if pos < len(df) else []
+
+
+# 儲存後端介面：整表讀取、差異寫入、單列查詢、版本標記；缺少任一方法的後端在建立時就會失敗
+class StorageBackend(ABC):
+    @abstractmethod
+    def read_records(self):
+        pass
+
+    @abstractmethod
+    def write_changes(self, snapshot, df):
+        pass
+
+    # 只寫入指定的列位置（snapshot 與 df 欄位相同、皆依位置排列）；df 以外的位置清空
+    @abstractmethod
+    def write_rows(self, snapshot, df, positions):
+        pass
+
+    @abstractmethod
+    def read_version(self):
+        pass
+
+    # 一次讀取所有資料表的版本標記 {資料表: 版本}
+    @abstractmethod
+    def read_versions(self):
+        pass
+
+    @abstractmethod
+    def bump_version(self):
+        pass
+
+
+# Google Sheets 後端（也可包裝 FakeSpreadsheet 做離線壓測）
+# connect 為回傳試算表的函式，工作表在第一次讀寫時才開啟
+class SheetsBackend(StorageBackend):
+    def __init__(self, connect, table="records"):
+        self.connect = connect
+        self.table = table
+        self.version_cell = TABLES[table]["version_cell"]
+        self.lock = threading.Lock()
+        self.spreadsheet = None
+        self.handles = None
+        self.header = []
+
+    def open(self):
+        with self.lock:
+            if self.handles is None:
+                self.spreadsheet = self.connect()
+                sheet = self.spreadsheet.get_worksheet(0) if self.table == "records" else self.open_worksheet(self.table, rows=100, cols=len(TABLES[self.table]["columns"]))
+                meta = self.open_worksheet(META_SHEET_NAME, rows=1, cols=len(TABLES))
+                self.handles = (sheet, meta)
+            return self.handles
+
+    @property
+    def sheet(self):
+        return self.open()[0]
+
+    @property
+    def meta(self):
+        return self.open()[1]
+
+    def open_worksheet(self, title, rows, cols):
+        try:
+            return self.spreadsheet.worksheet(title)
+        except gspread.WorksheetNotFound:
+            return self.spreadsheet.add_worksheet(title=title, rows=rows, cols=cols)
+
+    def read_records(self):
+        records = self.sheet.get_all_records()
+        self.header = list(records[0].keys()) if records else []
+        return records
+
+    def write_changes(self, snapshot, df):
+        old_grid = to_grid(snapshot) if self.header else []
+        new_grid = to_grid(df)
+        updates = diff_grid_updates(old_grid, new_grid, [list(df.columns)] + df.values.tolist())
+        if updates:
+            self.ensure_grid_size(len(new_grid), max(len(new_grid[0]), len(old_grid[0]) if old_grid else 0))
+            self.sheet.batch_update(updates)
+        self.header = list(df.columns)
+        return bool(updates)
+
+    # 第 1 列為標題，資料位置 p 在第 p + 2 列；標題與欄位不一致時改為整表比對
+    def write_rows(self, snapshot, df, positions):
+        if self.header != list(df.columns):
+            return self.write_changes(snapshot, df)
+        updates = []
+        for pos in positions:
+            values = df.iloc[pos].tolist() if pos < len(df) else []
+            update = diff_row_update(pos + 2, row_strings(snapshot, pos), [str(v) for v in values], values)
+            if update:
+                updates.append(update)
+        if updates:
+            self.ensure_grid_size(len(df) + 1, len(df.columns))
+            self.sheet.batch_update(updates)
+        return bool(updates)
+
+    def ensure_grid_size(self, rows, cols):
+        if rows > self.sheet.row_count:
+            self.sheet.add_rows(rows - self.sheet.row_count)
+        if cols > self.sheet.col_count:
+            self.sheet.add_cols(cols - self.sheet.col_count)
+
+    def ensure_header(self):
+        if not self.header:
+            self.header = self.sheet.row_values(1)
+        return self.header
+
+    def read_version(self):
+        return self.meta.acell(self.version_cell).value or ""
+
+    # 只呼叫一次 API；gspread 會省略尾端的空白儲存格，不足的欄位補空字串
+    def read_versions(self):
+        values = self.meta.get(VERSION_RANGE)
+        row = list(values[0]) if values else []
+        row += [""] * (len(TABLES) - len(row))
+        return {table: str(row[a1_to_rowcol(spec["version_cell"])[1] - 1] or "") for table, spec in TABLES.items()}
+
+    def bump_version(self):
+        version = uuid.uuid4().hex
+        self.meta.update_acell(self.version_cell, version)
+        return version
+
+
+# 本機 SQLite 後端：每列一筆，常用查詢欄位建立索引
+class SQLiteBackend(StorageBackend):
+    INDEXED_COLUMNS = ["user_id", "activity_id", "group_name", "row_type"]
+
+    def __init__(self, path, table="records"):
+        self.lock = threading.Lock()
+        self.table = table
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self.conn.execute(f'CREATE TABLE IF NOT EXISTS "{table}" (row_pos INTEGER PRIMARY KEY)')
+        self.ensure_columns(TABLES[table]["columns"])
+
+    def columns(self):
+        return [r[1] for r in self.conn.execute(f'PRAGMA table_info("{self.table}")') if r[1] != "row_pos"]
+
+    def ensure_columns(self, columns):
+        existing = set(self.columns())
+        for col in columns:
+            if col not in existing:
+                self.conn.execute(f'ALTER TABLE "{self.table}" ADD COLUMN "{col}" TEXT DEFAULT \'\'')
+                if col in self.INDEXED_COLUMNS:
+                    self.conn.execute(f'CREATE INDEX IF NOT EXISTS "idx_{self.table}_{col}" ON "{self.table}" ("{col}")')
+
+    def read_records(self):
+        with self.lock:
+            columns = self.columns()
+            rows = self.conn.execute(f'SELECT {quote_columns(columns)} FROM "{self.table}" ORDER BY row_pos').fetchall()
+        return [dict(zip(columns, row)) for row in rows]
+
+    def write_changes(self, snapshot, df):
+        old = snapshot.reindex(columns=df.columns).fillna("").astype(str).values.tolist()
+        new = df.astype(str).values.tolist()
+        changed = [i for i, row in enumerate(new) if i >= len(old) or row != old[i]]
+        columns = list(df.columns)
+        with self.lock:
+            self.ensure_columns(columns)
+            placeholders = ", ".join("?" * (len(columns) + 1))
+            self.conn.execute("BEGIN")
+            self.conn.executemany(
+                f'INSERT OR REPLACE INTO "{self.table}" (row_pos, {quote_columns(columns)}) VALUES ({placeholders})',
+                [[i] + new[i] for i in changed],
+            )
+            cur = self.conn.execute(f'DELETE FROM "{self.table}" WHERE row_pos >= ?', (len(new),))
+            self.conn.execute("COMMIT")
+        return bool(changed) or cur.rowcount > 0
+
+    def write_rows(self, snapshot, df, positions):
+        columns = list(df.columns)
+        rows = [[pos] + row_strings(df, pos) for pos in positions if pos < len(df)]
+        with self.lock:
+            self.ensure_columns(columns)
+            placeholders = ", ".join("?" * (len(columns) + 1))
+            self.conn.execute("BEGIN")
+            self.conn.executemany(
+                f'INSERT OR REPLACE INTO "{self.table}" (row_pos, {quote_columns(columns)}) VALUES ({placeholders})',
+                rows,
+            )
+            cur = self.conn.execute(f'DELETE FROM "{self.table}" WHERE row_pos >= ?', (len(df),))
+            self.conn.execute("COMMIT")
+        return bool(rows) or cur.rowcount > 0
+
+    def read_version(self):
+        with self.lock:
+            row = self.conn.execute("SELECT value FROM meta WHERE key = ?", (f"version:{self.table}",)).fetchone()
+        return row[0] if row else ""
+
+    def read_versions(self):
+        with self.lock:
+            rows = self.conn.execute("SELECT key, value FROM meta WHERE key LIKE 'version:%'").fetchall()
+        versions = dict.fromkeys(TABLES, "")
+        versions.update((key.split(":", 1)[1], value) for key, value in rows)
+        return versions
+
+    def bump_version(self):
+        version = uuid.uuid4().hex
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (f"version:{self.table}", version))
+        return version
+
+
+# 記憶體內的假試算表，模擬 gspread Worksheet 的讀寫語意（離線壓測用）
+class FakeWorksheet:
+    def __init__(self, title, rows=1000, cols=26):
+        self.title = title
+        self.row_count = rows
+        self.col_count = cols
+        self.cells = {}
+        self.lock = threading.Lock()
+
+    def get_all_values(self):
+        with self.lock:
+            if not self.cells:
+                return []
+            height = max(r for r, _ in self.cells)
+            width = max(c for _, c in self.cells)
+            return [[self.cells.get((r, c), "") for c in range(1, width + 1)] for r in range(1, height + 1)]
+
+    def get_all_records(self):
+        values = self.get_all_values()
+        if not values:
+            return []
+        header = values[0]
+        return [dict(zip(header, numericise_all(row))) for row in values[1:]]
+
+    def row_values(self, row):
+        with self.lock:
+            width = max((c for r, c in self.cells if r == row), default=0)
+            return [self.cells.get((row, c), "") for c in range(1, width + 1)]
+
+    def update(self, values, range_name="A1"):
+        start_row, start_col = a1_to_rowcol(range_name.split(":")[0])
+        with self.lock:
+            for i, row in enumerate(values):
+                for j, value in enumerate(row):
+                    key = (start_row + i, start_col + j)
+                    if value == "" or value is None:
+                        self.cells.pop(key, None)
+                    else:
+                        self.cells[key] = str(value)
+            self.row_count = max(self.row_count, start_row + len(values) - 1)
+        return {"updatedRows": len(values)}
+
+    def batch_update(self, data):
+        for item in data:
+            self.update(item["values"], item["range"])
+        return {"totalUpdatedRanges": len(data)}
+
+    def clear(self):
+        with self.lock:
+            self.cells.clear()
+
+    def get(self, range_name):
+        (first_row, first_col), (last_row, last_col) = (a1_to_rowcol(part) for part in range_name.split(":"))
+        with self.lock:
+            return [[self.cells.get((r, c), "") for c in range(first_col, last_col + 1)] for r in range(first_row, last_row + 1)]
+
+    def acell(self, label):
+        row, col = a1_to_rowcol(label)
+        return Cell(row, col, self.cells.get((row, col), ""))
+
+    def update_acell(self, label, value):
+        return self.update([[value]], label)
+
+    def add_rows(self, rows):
+        self.row_count += rows
+
+    def add_cols(self, cols):
+        self.col_count += cols
+
+
+class FakeSpreadsheet:
+    def __init__(self):
+        self.worksheets = {"Sheet1": FakeWorksheet("Sheet1")}
+
+    @property
+    def sheet1(self):
+        return self.worksheets["Sheet1"]
+
+    def get_worksheet(self, index):
+        return list(self.worksheets.values())[index]
+
+    def worksheet(self, title):
+        if title not in self.worksheets:
+            raise gspread.WorksheetNotFound(title)
+        return self.worksheets[title]
+
+    def add_worksheet(self, title, rows, cols):
+        self.worksheets[title] = FakeWorksheet(title, rows, cols)
+        return self.worksheets[title]
+
+
+def is_transient_error(e):
+    if isinstance(e, gspread.exceptions.APIError):
+        return e.response.status_code in RETRY_STATUS
+    return isinstance(e, (requests.ConnectionError, requests.Timeout))
+
+# 暫時性錯誤（429／5xx／連線中斷）以指數退避加隨機抖動重試，其餘錯誤直接拋出
+def with_retry(call, *args, **kwargs):
+    for attempt in range(RETRY_ATTEMPTS):
+        try:
+            return call(*args, **kwargs)
+        except Exception as e:
+            if attempt == RETRY_ATTEMPTS - 1 or not is_transient_error(e):
+                raise
+            time.sleep(random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt)))
+
+
+_local = threading.local()
+
+# 標記目前執行緒的 Sheets API 呼叫為背景工作（例如定期歸檔），排在互動操作之後
+@contextmanager
+def background():
+    previous = getattr(_local, "background", False)
+    _local.background = True
+    try:
+        yield
+    finally:
+        _local.background = previous
+
+def current_priority(kind):
+    if getattr(_local, "background", False):
+        return PRIORITY_BACKGROUND
+    return PRIORITY_WRITE if kind == "write" else PRIORITY_READ
+
+
+# 全程序共用的 Sheets API 配額排程：讀、寫各一個權杖桶，配額不足時依優先順序排隊等待而不是失敗
+class QuotaScheduler:
+    def __init__(self, per_minute=SHEETS_QUOTA_PER_MINUTE, burst=SHEETS_QUOTA_BURST):
+        self.cond = threading.Condition()
+        self.rates = {kind: quota / 60.0 for kind, quota in per_minute.items()}
+        self.capacity = {kind: min(burst, quota) for kind, quota in per_minute.items()}
+        self.tokens = dict(self.capacity)
+        self.updated = time.monotonic()
+        self.waiting = {kind: [] for kind in per_minute}
+        self.seq = itertools.count()
+
+    def refill(self):
+        now = time.monotonic()
+        for kind, rate in self.rates.items():
+            self.tokens[kind] = min(self.capacity[kind], self.tokens[kind] + (now - self.updated) * rate)
+        self.updated = now
+
+    # 排在最前面（優先順序最高、最早到）且桶中有權杖時才放行
+    def acquire(self, kind, priority):
+        with self.cond:
+            entry = (priority, next(self.seq))
+            waiting = self.waiting[kind]
+            heapq.heappush(waiting, entry)
+            while True:
+                self.refill()
+                if waiting[0] == entry and self.tokens[kind] >= 1:
+                    self.tokens[kind] -= 1
+                    heapq.heappop(waiting)
+                    self.cond.notify_all()
+                    return
+                timeout = (1 - self.tokens[kind]) / self.rates[kind] if waiting[0] == entry else None
+                self.cond.wait(timeout)
+
+    def call(self, kind, fn, *args, **kwargs):
+        self.acquire(kind, current_priority(kind))
+        count(f"sheets_api.{kind}")
+        return fn(*args, **kwargs)
+
+    def depth(self):
+        with self.cond:
+            return {kind: len(waiting) for kind, waiting in self.waiting.items()}
+
+
+_scheduler = QuotaScheduler()
+
+# 包裝 gspread 的試算表／工作表：每次呼叫前確認憑證有效、經配額排程並套用重試，取得的工作表同樣包裝
+class RetryingProxy:
+    def __init__(self, target, client):
+        self.target = target
+        self.client = client
+
+    def wrap(self, value):
+        if isinstance(value, (gspread.Worksheet, gspread.Spreadsheet)):
+            return RetryingProxy(value, self.client)
+        return value
+
+    def __getattr__(self, name):
+        self.client.ensure_token()
+        attr = with_retry(getattr, self.target, name)
+        if not callable(attr):
+            return self.wrap(attr)
+
+        kind = "write" if name in WRITE_METHODS else "read"
+
+        def call(*args, **kwargs):
+            self.client.ensure_token()
+            return self.wrap(with_retry(_scheduler.call, kind, attr, *args, **kwargs))
+        return call
+
+
+# 全程序共用的 Google Sheets 連線：第一次使用時才驗證並開啟試算表，之後所有 session 共用
+class SheetsClient:
+    def __init__(self, name=SHEET_NAME):
+        self.name = name
+        self.lock = threading.Lock()
+        self.token_lock = threading.Lock()
+        self.credentials = None
+        self.spreadsheet = None
+
+    def open(self):
+        with self.lock:
+            if self.spreadsheet is None:
+                credentials = service_account.Credentials.from_service_account_info(st.secrets["gspread"])
+                self.credentials = credentials.with_scopes([
+                    "https://www.googleapis.com/auth/spreadsheets",
+                    "https://www.googleapis.com/auth/drive"
+                ])
+                client = gspread.authorize(self.credentials)
+                self.spreadsheet = RetryingProxy(with_retry(client.open, self.name), self)
+            return self.spreadsheet
+
+    # 存取權杖過期前由單一執行緒更新，避免多個 session 同時換發
+    def ensure_token(self):
+        if self.credentials is None or self.credentials.valid:
+            return
+        with self.token_lock:
+            if not self.credentials.valid:
+                with_retry(self.credentials.refresh, Request())
+
+
+_sheets_client = SheetsClient()
+
+# 依環境變數 NOJO_STORAGE 選擇後端：sheets（預設）、sqlite、memory；各資料表共用同一份試算表
+def create_backends(kind=None):
+    kind = kind or os.environ.get("NOJO_STORAGE", "sheets")
+    if kind == "sqlite":
+        path = os.environ.get("NOJO_SQLITE_PATH", "meeting_records.db")
+        return {table: SQLiteBackend(path, table) for table in TABLES}
+    if kind == "memory":
+        spreadsheet = FakeSpreadsheet()
+        return {table: SheetsBackend(lambda: spreadsheet, table) for table in TABLES}
+    return {table: SheetsBackend(_sheets_client.open, table) for table in TABLES}
+
+
+# 全程序共用的資料集快取（所有 session 共享，寫入時立即更新）
+class DatasetStore:
+    def __init__(self, backend, columns=DEFAULT_COLUMNS):
+        self.backend = backend
+        self.columns = columns
+        self.lock = threading.Lock()
+        self.df = None
+        self.version = None
+        self.checked_at = 0.0
+        self.generation = 0
+        self.key_indexes = {}
+        self.indexes = {}
+        self.typed = None
+
+    def is_fresh(self):
+        return self.df is not None and time.time() - self.checked_at < VERSION_CHECK_INTERVAL
+
+    def set_snapshot(self, df, version):
+        self.df = df
+        self.version = version
+        self.generation += 1
+        self.key_indexes = {}
+        self.checked_at = time.time()
+
+    # 短時間內直接使用記憶體中的資料，超過檢查間隔才比對版本標記（呼叫端需持有 lock）；
+    # version 為呼叫端已一併讀到的版本標記，有傳入時不再讀取後端
+    def refresh(self, latest=False, version=None):
+        if self.is_fresh() and not latest:
+            return
+        if version is None:
+            version = self.backend.read_version()
+            count("backend.read_version")
+        if self.df is None or version != self.version:
+            df = records_to_df(self.backend.read_records(), self.columns)
+            count("backend.read_records")
+            count("rows_read", len(df))
+            count("bytes_read", frame_bytes(df))
+            self.set_snapshot(df, version)
+        self.checked_at = time.time()
+
+    # 一律深複製：寫入操作會直接修改工作區的資料，不能與快取共用底層陣列（pandas 2 沒有 copy-on-write）
+    def get_df(self, latest=False):
+        with self.lock:
+            self.refresh(latest)
+            return self.df.copy()
+
+    # 型別化檢視，每個資料版本只解析一次（呼叫端需持有 lock）
+    def typed_df(self):
+        if self.typed is None or self.typed[0] != self.generation:
+            self.typed = (self.generation, to_typed(self.df))
+        return self.typed[1]
+
+    # 所有 session 共用同一份，讀取端不可修改
+    def get_typed(self):
+        with self.lock:
+            self.refresh()
+            return self.typed_df()
+
+    # 目前的版本標記；所有 session 共用同一次檢查，檢查間隔內不會讀取後端
+    def get_version(self):
+        with self.lock:
+            self.refresh()
+            return self.version
+
+    # 由快照衍生的索引，每個資料版本只建立一次
+    def get_index(self, name, builder, typed=False):
+        with self.lock:
+            self.refresh()
+            cached = self.indexes.get(name)
+            if cached is None or cached[0] != self.generation:
+                cached = (self.generation, builder(self.typed_df() if typed else self.df), typed)
+                self.indexes[name] = cached
+            return cached[1]
+
+    # 只取快取不建立：回傳 (索引, 是否為目前資料版本)，沒有快取時為 (None, False)
+    def peek_index(self, name):
+        with self.lock:
+            self.refresh()
+            cached = self.indexes.get(name)
+            if cached is None:
+                return None, False
+            return cached[1], cached[0] == self.generation
+
+    # 背景預先建立索引：解析型別化檢視與建立索引期間都不持有 lock，讀取端照常使用；
+    # 完成時資料版本變了就重來，連續 attempts 次都追不上寫入時放棄，留給第一次使用時建立
+    def warm_index(self, name, builder, typed=False, attempts=3):
+        for _ in range(attempts):
+            with self.lock:
+                self.refresh()
+                cached = self.indexes.get(name)
+                if cached is not None and cached[0] == self.generation:
+                    return cached[1]
+                generation, df, view = self.generation, self.df, self.typed
+            if typed:
+                df = view[1] if view is not None and view[0] == generation else to_typed(df)
+            index = builder(df)
+            with self.lock:
+                if self.generation == generation:
+                    if typed and (self.typed is None or self.typed[0] != generation):
+                        self.typed = (generation, df)
+                    self.indexes[name] = (generation, index, typed)
+                    return index
+        return None
+
+    # touched 為寫入操作標記過的列 label（新增、修改、刪除）；None 表示不知道改了哪些列，整表比對
+    @instrument("save_df")
+    def save_df(self, df, touched=None):
+        with self.lock:
+            if touched is not None and self.df is not None and list(df.columns) == list(self.df.columns):
+                if self.save_rows(df, touched):
+                    return
+            snapshot = self.df if self.df is not None else records_to_df(self.backend.read_records(), self.columns)
+            df = arrange_rows(snapshot, serialize_frame(df, snapshot))
+            version = self.version
+            count("backend.write_changes")
+            if self.backend.write_changes(snapshot, df):
+                version = self.backend.bump_version()
+                count("backend.bump_version")
+            generation = self.generation
+            self.set_snapshot(df.copy(), version)
+            positions = changed_positions(snapshot, self.df)
+            count("rows_written", len(positions))
+            count("bytes_written", frame_bytes(self.df.iloc[[p for p in positions if p < len(self.df)]]))
+            self.patch_indexes(generation, snapshot, positions)
+
+    # 只處理標記過的列：刪除留下的空位依序由新增列、再由尾端列補上（與 arrange_rows 相同），
+    # 序列化、比對與寫入都只碰這些位置；列數對不上（有未標記的新增或刪除）時回傳 False 改走整表比對
+    def save_rows(self, df, touched):
+        snapshot = self.df
+        old_len, total = len(snapshot), len(df)
+        labels = set(touched)
+        deleted = sorted(label for label in labels if 0 <= label < old_len and label not in df.index)
+        added = sorted(label for label in labels if not 0 <= label < old_len and label in df.index)
+        if total != old_len - len(deleted) + len(added):
+            return False
+        gone = set(deleted)
+        slots = [pos for pos in deleted if pos < total] + list(range(old_len, total))
+        movers = added + [pos for pos in range(total, old_len) if pos not in gone]
+        if slots or not df.index.equals(snapshot.index):
+            order = np.arange(total)
+            order[slots] = movers
+            df = df.reindex(order).reset_index(drop=True)
+        updated = {label for label in labels if 0 <= label < min(old_len, total) and label not in gone}
+        positions = sorted(updated | set(slots) | set(range(total, old_len)))
+
+        # 只有這些列可能含有 list、日期等尚未轉成字串的值
+        written = [pos for pos in positions if pos < total]
+        rows = df.iloc[written]
+        for j, col in enumerate(df.columns):
+            column = rows[col]
+            fresh = serialize_column(column)
+            if fresh is column and not column.isna().any():
+                continue
+            fresh = fresh.fillna("")
+            if fresh.dtype != df[col].dtype:
+                df[col] = df[col].astype(object)
+            df.iloc[written, j] = fresh.to_numpy()
+        changed = [pos for pos in positions if row_strings(snapshot, pos) != row_strings(df, pos)]
+
+        version = self.version
+        count("backend.write_rows")
+        if changed and self.backend.write_rows(snapshot, df, changed):
+            version = self.backend.bump_version()
+            count("backend.bump_version")
+        generation = self.generation
+        self.set_snapshot(df, version)
+        count("rows_written", len(changed))
+        count("bytes_written", frame_bytes(df.iloc[[pos for pos in changed if pos < total]]))
+        self.patch_indexes(generation, snapshot, changed)
+        return True
+
+    # 支援 update_rows 的索引只套用變動的列，其餘索引留待下次使用時重建；
+    # 以型別化檢視建立的索引拿到的也是型別化的列
+    def patch_indexes(self, generation, snapshot, positions):
+        if not positions:
+            for name, (gen, index, typed) in list(self.indexes.items()):
+                if gen == generation:
+                    self.indexes[name] = (self.generation, index, typed)
+            return
+        old_rows = snapshot.iloc[[p for p in positions if p < len(snapshot)]]
+        new_rows = self.df.iloc[[p for p in positions if p < len(self.df)]]
+        typed_rows = None
+        for name, (gen, index, typed) in list(self.indexes.items()):
+            if gen == generation and hasattr(index, "update_rows"):
+                if typed and typed_rows is None:
+                    typed_rows = (to_typed_rows(old_rows), to_typed_rows(new_rows))
+                index.update_rows(*(typed_rows if typed else (old_rows, new_rows)))
+                self.indexes[name] = (self.generation, index, typed)
+
+    def key_index(self, column):
+        if column not in self.key_indexes:
+            values = self.df[column].astype(str).tolist()
+            self.key_indexes[column] = {v: label for v, label in zip(reversed(values), reversed(self.df.index))}
+        return self.key_indexes[column]
+
+    # 單列查詢：一律由快取回答；快取過期時只比對一次版本標記，資料沒變就不讀取後端
+    def get_row(self, column, value):
+        with self.lock:
+            self.refresh()
+            if column not in self.df.columns:
+                return None
+            label = self.key_index(column).get(str(value))
+            return None if label is None else self.df.loc[label].to_dict()
+
+
+# 寫入佇列中的操作拿到的工作區，操作直接修改 ws.df
+class Workspace:
+    def __init__(self, stores, latest=True):
+        self.stores = stores
+        self.latest = latest
+        self.frames = {}
+        self.claims = set()
+        # 操作以 touch／append／drop 標記改過的列，寫回時只比對這些列；
+        # 用到資料表卻沒有標記的操作無從得知改了什麼，該資料表改為整表比對
+        self.touched = {}
+        self.untracked = set()
+        self.accessed = set()
+        self.marked = set()
+
+    # 第一次用到某資料表時才讀取（寫入者一律取最新版本）
+    def table(self, name):
+        self.accessed.add(name)
+        if name not in self.frames:
+            self.frames[name] = self.stores[name].get_df(latest=self.latest)
+        return self.frames[name]
+
+    def set_table(self, name, frame):
+        self.accessed.add(name)
+        self.frames[name] = frame
+
+    @property
+    def df(self):
+        return self.table("records")
+
+    @df.setter
+    def df(self, value):
+        self.set_table("records", value)
+
+    @property
+    def events(self):
+        return self.table("events")
+
+    @events.setter
+    def events(self, value):
+        self.set_table("events", value)
+
+    def touch(self, labels, table="records"):
+        self.touched.setdefault(table, set()).update(labels)
+        self.marked.add(table)
+
+    # 新增列接在目前最大的 label 之後，不重新編號既有的列
+    def append(self, rows, table="records"):
+        frame = self.table(table)
+        if not rows:
+            self.touch([], table)
+            return frame.index[:0]
+        start = int(frame.index.max()) + 1 if len(frame) else 0
+        rows = pd.DataFrame(rows).set_axis(range(start, start + len(rows)))
+        self.set_table(table, pd.concat([frame, rows]))
+        self.touch(rows.index, table)
+        return rows.index
+
+    def drop(self, labels, table="records"):
+        labels = list(labels)
+        self.set_table(table, self.table(table).drop(labels))
+        self.touch(labels, table)
+
+    # 執行一個操作並記錄它用到、標記了哪些資料表（可巢狀，例如交易內的各個操作）
+    def run(self, op):
+        outer = (self.accessed, self.marked)
+        self.accessed, self.marked = set(), set()
+        try:
+            return op(self)
+        finally:
+            self.untracked |= self.accessed - self.marked
+            self.accessed = outer[0] | self.accessed
+            self.marked = outer[1] | self.marked
+
+    # 寫回時要比對的列；None 表示整表比對
+    def touched_rows(self, name):
+        return None if name in self.untracked else self.touched.get(name, set())
+
+    # 同一批次內避免重複建立同名資料（例如兩個 session 同時建立同名群組）
+    def claim(self, kind, key):
+        if (kind, key) in self.claims:
+            return False
+        self.claims.add((kind, key))
+        return True
+
+
+# 全程序唯一的寫入者：收集一小段時間內的操作，套用在最新資料上後一次寫回
+class MutationQueue:
+    def __init__(self, stores, window=COALESCE_WINDOW):
+        self.stores = stores
+        self.window = window
+        self.pending = queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def ensure_writer(self):
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, name="nojo-writer", daemon=True)
+                self.thread.start()
+
+    def submit(self, op, timeout=MUTATION_TIMEOUT):
+        future = Future()
+        self.pending.put((op, future, getattr(_local, "background", False)))
+        self.ensure_writer()
+        return future.result(timeout=timeout)
+
+    def run(self):
+        while True:
+            batch = [self.pending.get()]
+            deadline = time.time() + self.window
+            while True:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.pending.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            # 整批都是背景工作時才以背景優先順序寫入
+            _local.background = all(bg for _, _, bg in batch)
+            self.apply([(op, future) for op, future, _ in batch])
+
+    def apply(self, batch):
+        ws = Workspace(self.stores)
+        outcomes = []
+        for op, future in batch:
+            try:
+                outcomes.append((future, ws.run(op), None))
+            except Exception as e:
+                outcomes.append((future, None, e))
+        saved = []
+        try:
+            for name in sorted(ws.frames, key=SAVE_ORDER.index):
+                previous = self.stores[name].df
+                self.stores[name].save_df(ws.frames[name], ws.touched_rows(name))
+                saved.append((name, previous))
+        except Exception as e:
+            self.restore(saved)
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        for future, result, error in outcomes:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+    # 後面的資料表寫入失敗時，把已寫入的資料表整表比對寫回原本的內容
+    def restore(self, saved):
+        for name, previous in reversed(saved):
+            try:
+                self.stores[name].save_df(previous)
+            except Exception:
+                logging.exception("還原資料表 %s 失敗", name)
+
+
+# 交易：區塊內的修改操作先套用在本地工作區取得結果，離開區塊時整批交給寫入佇列一次套用、一次寫回
+class Transaction:
+    def __init__(self, stores):
+        self.preview = Workspace(stores, latest=False)
+        self.ops = []
+        self.results = None
+
+    def add(self, op):
+        self.ops.append(op)
+        return op(self.preview)
+
+    # 在寫入者的工作區依序重放；任一操作失敗時還原本交易造成的修改，不影響同批其他操作
+    def apply(self, ws):
+        frames = {name: frame.copy() for name, frame in ws.frames.items()}
+        claims = set(ws.claims)
+        try:
+            return [ws.run(op) for op in self.ops]
+        except Exception:
+            ws.frames = frames
+            ws.claims = claims
+            raise
+
+
+_stores = {table: DatasetStore(backend, TABLES[table]["columns"]) for table, backend in create_backends().items()}
+_mutations = MutationQueue(_stores)
+
+def get_store(table="records"):
+    return _stores[table]
+
+@instrument("get_df")
+def get_df(table="records"):
+    return _stores[table].get_df()
+
+def get_version(table="records"):
+    return _stores[table].get_version()
+
+# 多個資料表的版本標記：有資料表超過檢查間隔時只讀一次後端（試算表為 _meta!A1:C1 一次呼叫），
+# 再由各資料表比對，版本變了才重新載入
+def get_versions(tables):
+    stores = [_stores[table] for table in tables]
+    versions = {}
+    if not all(store.is_fresh() for store in stores):
+        versions = stores[0].backend.read_versions()
+        count("backend.read_versions")
+    result = []
+    for table, store in zip(tables, stores):
+        with store.lock:
+            store.refresh(version=versions.get(table))
+            result.append(store.version)
+    return tuple(result)
+
+def get_row(column, value, table="records"):
+    return _stores[table].get_row(column, value)
+
+def get_typed_df(table="records"):
+    return _stores[table].get_typed()
+
+def get_index(name, builder, table="records", typed=False):
+    return _stores[table].get_index(name, builder, typed)
+
+def warm_index(name, builder, table="records", typed=False):
+    return _stores[table].warm_index(name, builder, typed)
+
+def peek_index(name, table="records"):
+    return _stores[table].peek_index(name)
+
+# Sheets API 配額排程中各類請求的排隊數
+def quota_queue_depth():
+    return _scheduler.depth()
+
+# 把修改操作交給寫入佇列，等待套用完成並回傳操作結果；在交易中則先收集起來
+def submit_mutation(op):
+    tx = getattr(_local, "transaction", None)
+    if tx is not None:
+        return tx.add(op)
+    return _mutations.submit(op)
+
+# with transaction() as tx: 區塊內的 submit_mutation 只讀一次資料，正常離開時一次寫回，
+# tx.results 為實際寫入時各操作的結果；區塊中發生例外則整批放棄
+@contextmanager
+def transaction():
+    current = getattr(_local, "transaction", None)
+    if current is not None:
+        yield current
+        return
+    tx = Transaction(_stores)
+    _local.transaction = tx
+    try:
+        yield tx
+    finally:
+        _local.transaction = None
+    if tx.ops:
+        tx.results = _mutations.submit(tx.apply)
+
+def save_df(df, table="records", touched=None):
+    _stores[table].save_df(df, touched)
+    return True
@@ -0,0 +1,6 @@
+import os
+import sys
+
+# 測試一律使用記憶體內的假試算表
+os.environ.setdefault("NOJO_STORAGE", "memory")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,201 @@
+import random
+from datetime import date, datetime, timedelta
+
+import pandas as pd
+
+from availability_module import AvailabilityRules, rules_from_tokens, build_rule_tokens, expand_slot_tokens
+from index_module import SlotIndex, AvailabilityIndex, AvailabilityMatrix
+from storage_module import MutationQueue, DEFAULT_COLUMNS
+
+from test_storage import make_stores
+
+START = date(2026, 10, 19)  # 週一
+DAYS = 60
+
+
+def day_token(d):
+    return d.isoformat()
+
+def random_rule_tokens(rng):
+    pick = lambda: START + timedelta(days=rng.randrange(-10, DAYS + 10))
+    tokens = []
+    for _ in range(rng.randrange(0, 4)):
+        kind = rng.random()
+        a, b = sorted((pick(), pick()))
+        if kind < 0.25:
+            tokens.append(day_token(a))
+        elif kind < 0.45:
+            tokens.append(f"{a}~{b}")
+        elif kind < 0.7:
+            days = "".join(sorted(set(rng.choice("1234567") for _ in range(rng.randrange(1, 4)))))
+            span = rng.choice(["", f"@{a}~{b}", f"@{a}~", f"@~{b}"])
+            tokens.append(f"W{days}{span}")
+        elif kind < 0.85:
+            tokens.append(f"!{a}")
+        else:
+            tokens.append(f"!{a}~{b}")
+    return tokens
+
+# 逐日直接依規則定義判斷，作為陣列展開的對照
+def brute_force_free(tokens, d):
+    free, excluded = False, False
+    for token in tokens:
+        negate = token.startswith("!")
+        body = token[1:] if negate else token
+        if body.startswith("W"):
+            days, _, span = body[1:].partition("@")
+            first, _, last = span.partition("~")
+            hit = str(d.isoweekday()) in days and (not first or d >= date.fromisoformat(first)) and (not last or d <= date.fromisoformat(last))
+        elif "~" in body:
+            first, last = body.split("~")
+            hit = date.fromisoformat(first) <= d <= date.fromisoformat(last)
+        else:
+            hit = d == date.fromisoformat(body)
+        if negate:
+            excluded |= hit
+        else:
+            free |= hit
+    return free and not excluded
+
+# 規則展開的遮罩與逐日判斷一致（含限定期間的每週規則與排除區間）
+def test_rule_mask_matches_brute_force():
+    rng = random.Random(7)
+    for _ in range(300):
+        tokens = random_rule_tokens(rng)
+        bits = AvailabilityRules(tokens).mask(START, DAYS)
+        expected = [brute_force_free(tokens, START + timedelta(days=i)) for i in range(DAYS)]
+        assert bits.tolist() == expected, tokens
+
+# 重新組成的儲存格內容展開後不變；since 只清掉已結束的規則，不影響之後的日期
+def test_rule_tokens_round_trip():
+    rng = random.Random(8)
+    for _ in range(200):
+        rules = AvailabilityRules(random_rule_tokens(rng))
+        assert rules_from_tokens(tuple(rules.to_tokens())).mask(START, DAYS).tolist() == rules.mask(START, DAYS).tolist()
+        since = START + timedelta(days=20)
+        pruned = rules_from_tokens(tuple(rules.to_tokens(since)))
+        assert pruned.mask(since, DAYS).tolist() == rules.mask(since, DAYS).tolist()
+
+# 無法解析的片段略過，其他規則照常有效；排除日優先於每週規則
+def test_rule_parsing_edge_cases():
+    rules = AvailabilityRules(["2026-13-01", "W9", "W1", "!2026-10-26", "2026-10-30~2026-10-20", "garbage"])
+    bits = rules.mask(START, 15)
+    assert [START + timedelta(days=int(i)) for i in bits.nonzero()[0]] == [date(2026, 10, 19), date(2026, 11, 2)]
+    assert build_rule_tokens(dates=[date(2026, 10, 1)], weekly=[({0, 2}, None, date(2026, 10, 5))], since=START) == []
+
+
+def slot_frame(slots_by_user):
+    return pd.DataFrame({"user_id": list(slots_by_user), "available_slots": list(slots_by_user.values())})
+
+def at(day, hour, minute=0):
+    return datetime(day.year, day.month, day.day) + timedelta(hours=hour, minutes=minute)
+
+# 跨過午夜的時段延伸到隔天，與隔天凌晨相接或重疊的時段合併成一段
+def test_slot_index_merges_across_midnight():
+    tue = START + timedelta(days=1)
+    index = SlotIndex(slot_frame({
+        "a": ["2026-10-19 22:00-02:00", "2026-10-20 01:00-03:00"],
+        "b": ["W1 23:00-00:30", "2026-10-20 00:30-01:00"],
+        "c": ["2026-10-19 20:00-22:00"],
+    }), START, days=7)
+    assert index.by_user["a"] == [(at(START, 22), at(tue, 3))]
+    assert index.by_user["b"][0] == (at(START, 23), at(tue, 1))
+    assert index.users_free(at(tue, 0), at(tue, 2, 30)) == {"a"}
+    assert index.users_free(at(START, 23), at(tue, 1)) == {"a", "b"}
+    assert index.longest_common_window(["a", "b"]) == (at(START, 23), at(tue, 1), 2)
+    # 前一段 22:00 結束、下一段 22:00 開始的兩人，人數相同的相鄰片段合併
+    assert index.windows(["a", "c"], after=at(START, 21)) == [(at(START, 21), at(tue, 3), 1)]
+
+# 每週時段在視窗最後一天跨過午夜時，結束時間落在視窗之外也照常保留
+def test_weekly_slot_at_window_end():
+    intervals = expand_slot_tokens(("W7 23:00-01:00",), START, 7)
+    sunday = START + timedelta(days=6)
+    assert intervals == ((at(sunday, 23), at(sunday + timedelta(days=1), 1)),)
+
+# 連續每天整日有空合併成 8 週的長區間，索引仍切成不超過一天的片段，查詢只掃描附近的片段
+def test_long_merged_slots_stay_bounded():
+    users = {f"w{i}": [f"W{d} 00:00-00:00" for d in range(1, 8)] for i in range(5)}
+    users["short"] = ["W3 10:00-12:00"]
+    index = SlotIndex(slot_frame(users), START, days=56)
+    assert index.by_user["w0"] == [(at(START, 0), at(START + timedelta(days=56), 0))]
+    assert max(last - first for first, last, _ in index.entries) <= timedelta(hours=24)
+    wed = START + timedelta(days=2)
+    everyone = set(users)
+    assert index.users_free(at(wed, 10), at(wed, 12)) == everyone
+    assert index.users_free(at(wed, 11), at(wed + timedelta(days=10), 3)) == everyone - {"short"}
+    assert index.users_free(at(START, 0), at(START + timedelta(days=56), 0)) == everyone - {"short"}
+    assert index.users_free(at(wed, 12), at(wed, 13)) == everyone - {"short"}
+
+# 區間查詢與逐一比對所有使用者的區間結果相同
+def test_users_free_matches_brute_force():
+    rng = random.Random(9)
+    slots = {}
+    for u in range(40):
+        tokens = []
+        for _ in range(rng.randrange(1, 4)):
+            first, length = rng.randrange(0, 24 * 4) * 15, rng.randrange(1, 16) * 30
+            when = rng.choice([f"W{rng.randrange(1, 8)}", (START + timedelta(days=rng.randrange(7))).isoformat()])
+            tokens.append(f"{when} {first // 60:02d}:{first % 60:02d}-{(first + length) // 60 % 24:02d}:{(first + length) % 60:02d}")
+        slots[f"u{u}"] = tokens
+    index = SlotIndex(slot_frame(slots), START, days=7)
+    for _ in range(300):
+        start = at(START, 0) + timedelta(minutes=rng.randrange(0, 7 * 24 * 4) * 15)
+        end = start + timedelta(minutes=rng.randrange(1, 12) * 30)
+        expected = {u for u, merged in index.by_user.items() if any(first <= start and last >= end for first, last in merged)}
+        assert index.users_free(start, end) == expected
+
+def random_slot_tokens(rng):
+    tokens = []
+    for _ in range(rng.randrange(0, 3)):
+        when = rng.choice([f"W{rng.randrange(1, 8)}", (START + timedelta(days=rng.randrange(7))).isoformat()])
+        first, last = rng.randrange(24), rng.randrange(24)
+        tokens.append(f"{when} {first:02d}:00-{last:02d}:00")
+    return ",".join(tokens)
+
+def slot_users(index):
+    return {u: list(merged) for u, merged in index.by_user.items()}
+
+# 新增、刪除使用者與修改空閒日期、時段後，差異更新的三種空閒索引與重新建立的結果相同；
+# 只改好友等其他欄位的寫入不重建這些索引
+def test_patched_availability_indexes_match_rebuild():
+    stores = make_stores()
+    store = stores["records"]
+    rng = random.Random(10)
+    rows = [{"user_id": f"u{i}", "available_dates": ",".join(random_rule_tokens(rng)), "available_slots": random_slot_tokens(rng)} for i in range(30)]
+    store.save_df(pd.DataFrame(rows).reindex(columns=DEFAULT_COLUMNS).fillna(""))
+    builders = {
+        "availability": lambda df: AvailabilityIndex(df, START, DAYS),
+        "availability_matrix": lambda df: AvailabilityMatrix(df, START, DAYS),
+        "slots": lambda df: SlotIndex(df, START, days=7),
+    }
+    indexes = {name: store.get_index(name, build, typed=True) for name, build in builders.items()}
+    queue = MutationQueue(stores, window=0)
+    for step in range(60):
+        kind = rng.random()
+
+        def op(ws, kind=kind):
+            labels = list(ws.df.index)
+            if kind < 0.15:
+                ws.append([{"user_id": f"n{step}", "available_dates": ",".join(random_rule_tokens(rng)), "available_slots": random_slot_tokens(rng)}])
+            elif kind < 0.25:
+                ws.drop([rng.choice(labels)])
+            else:
+                label = rng.choice(labels)
+                ws.touch([label])
+                if kind < 0.5:
+                    ws.df.at[label, "friends"] = f"u{step}"
+                else:
+                    ws.df.at[label, "available_dates"] = ",".join(random_rule_tokens(rng))
+                    ws.df.at[label, "available_slots"] = random_slot_tokens(rng)
+        queue.submit(op)
+        for name, build in builders.items():
+            assert store.get_index(name, build, typed=True) is indexes[name]
+    rebuilt = {name: build(store.get_typed()) for name, build in builders.items()}
+    users = sorted(store.get_df()["user_id"])
+    patched = indexes["availability"]
+    assert {d: u for d, u in patched.by_date.items() if u} == {d: u for d, u in rebuilt["availability"].by_date.items() if u}
+    assert patched.sorted_dates == rebuilt["availability"].sorted_dates
+    assert patched.users_in_range(str(START), str(START + timedelta(days=20))) == rebuilt["availability"].users_in_range(str(START), str(START + timedelta(days=20)))
+    assert (indexes["availability_matrix"].rows(users, START, DAYS) == rebuilt["availability_matrix"].rows(users, START, DAYS)).all()
+    assert slot_users(indexes["slots"]) == slot_users(rebuilt["slots"])
+    assert indexes["slots"].entries == rebuilt["slots"].entries
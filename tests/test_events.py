@@ -0,0 +1,68 @@
+from datetime import date, timedelta
+
+import pandas as pd
+import pytest
+
+import storage_module
+from storage_module import MutationQueue, EVENT_COLUMNS
+import main
+
+from test_storage import make_stores, table_records
+
+
+def event_rows(dates):
+    rows = [{"activity_id": f"a{i}", "group_name": "g", "event_title": f"t{i}", "event_date": d} for i, d in enumerate(dates)]
+    return pd.DataFrame(rows).reindex(columns=EVENT_COLUMNS).fillna("")
+
+# main 透過模組層級的資料表與寫入佇列存取資料，每個測試換成新的記憶體資料表
+@pytest.fixture
+def stores(monkeypatch):
+    stores = make_stores()
+    monkeypatch.setattr(storage_module, "_stores", stores)
+    monkeypatch.setattr(storage_module, "_mutations", MutationQueue(stores, window=0))
+    past, future = date.today() - timedelta(days=3), date.today() + timedelta(days=3)
+    stores["events"].save_df(event_rows([str(past), str(future), str(past)]))
+    return stores
+
+def activity_ids(store):
+    return sorted(r["activity_id"] for r in store.backend.read_records())
+
+def test_sweep_moves_expired_events_to_archive(stores):
+    assert main.sweep_expired_events() == 2
+    assert activity_ids(stores["events"]) == ["a1"]
+    assert activity_ids(stores["events_archive"]) == ["a0", "a2"]
+
+# 歸檔表寫入後活動表寫入失敗：歸檔表還原，活動仍留在活動表
+def test_failed_events_write_keeps_events(stores, monkeypatch):
+    before = table_records(stores)
+
+    def fail(*args):
+        raise RuntimeError("quota exceeded")
+    monkeypatch.setattr(stores["events"].backend, "write_rows", fail)
+    monkeypatch.setattr(stores["events"].backend, "write_changes", fail)
+    with pytest.raises(RuntimeError):
+        main.sweep_expired_events()
+    assert table_records(stores) == before
+
+# 上次歸檔只寫完歸檔表時，重跑不會重複歸檔，歷史活動也不重複列出
+def test_sweep_after_partial_archive_does_not_duplicate(stores):
+    partial = event_rows([str(date.today() - timedelta(days=3))]).assign(archived_at="")
+    stores["events_archive"].save_df(partial)
+    assert main.get_past_event_rows("g")["activity_id"].tolist().count("a0") == 1
+    assert main.sweep_expired_events() == 1
+    assert activity_ids(stores["events_archive"]) == ["a0", "a2"]
+    assert activity_ids(stores["events"]) == ["a1"]
+
+# 同一批次中剛加入的成員還不在共用索引裡，刪除群組時也要一併移除
+def test_delete_group_uses_latest_rows(stores):
+    users = pd.DataFrame([{"user_id": "u0", "groups": "g", "group_members": "g:u0"}, {"user_id": "u1"}])
+    stores["records"].save_df(users.reindex(columns=storage_module.DEFAULT_COLUMNS).fillna(""))
+
+    def join(ws):
+        ws.touch([1])
+        main.set_group_membership(ws.df, 1, "u1", "g", True)
+    with storage_module.transaction():
+        storage_module.submit_mutation(join)
+        main.delete_group("g")
+    assert [r["groups"] for r in stores["records"].backend.read_records()] == ["", ""]
+    assert activity_ids(stores["events"]) == []
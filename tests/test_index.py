@@ -0,0 +1,188 @@
+import random
+import threading
+import time
+from datetime import date, timedelta
+
+import pandas as pd
+import pytest
+
+import storage_module
+import index_module
+from storage_module import MutationQueue, EVENT_COLUMNS, to_typed, to_typed_rows
+from index_module import MatchIndex, EventIndex
+
+from test_storage import make_stores, user_rows
+
+TODAY = date.today()
+
+
+def random_dates(rng):
+    days = rng.sample(range(30), rng.randrange(0, 8))
+    return ",".join(str(TODAY + timedelta(days=d)) for d in sorted(days))
+
+def match_scores(index, users):
+    return {u: [round(score, 5) for _, score, _ in index.top_matches(u)] for u in users}
+
+@pytest.fixture
+def stores():
+    stores = make_stores()
+    rng = random.Random(2)
+    df = user_rows(60)
+    df["available_dates"] = [random_dates(rng) for _ in range(len(df))]
+    stores["records"].save_df(df)
+    return stores
+
+def build(df):
+    return MatchIndex(df, TODAY, k=5)
+
+# 差異更新（含待重算的列）後的排行分數與重新建立的索引一致
+def test_patched_match_index_matches_rebuild(stores):
+    store = stores["records"]
+    index = store.get_index("matches", build, typed=True)
+    queue = MutationQueue(stores, window=0)
+    rng = random.Random(3)
+    users = [f"u{i}" for i in range(60)]
+    for step in range(80):
+        labels = rng.sample(range(60), rng.randrange(1, 4))
+
+        def op(ws, labels=labels):
+            ws.touch(labels)
+            for label in labels:
+                ws.df.at[label, "available_dates"] = random_dates(rng)
+        queue.submit(op)
+        assert store.get_index("matches", build, typed=True) is index
+        if step % 10 == 9:
+            assert match_scores(index, users) == match_scores(build(store.get_typed()), users)
+
+# 寫入者套用差異的同時讀取端查詢（會重算待更新的列），不會讀到半更新的陣列
+def test_concurrent_reads_during_updates(stores):
+    store = stores["records"]
+    index = store.get_index("matches", build, typed=True)
+    queue = MutationQueue(stores, window=0)
+    users = [f"u{i}" for i in range(60)]
+    errors = []
+    done = threading.Event()
+
+    def read():
+        rng = random.Random()
+        while not done.is_set():
+            try:
+                for _, score, common in index.top_matches(rng.choice(users)):
+                    assert 0 < score <= 1 and common >= 0
+            except Exception as e:
+                errors.append(e)
+
+    readers = [threading.Thread(target=read) for _ in range(4)]
+    for reader in readers:
+        reader.start()
+    rng = random.Random(4)
+    for step in range(60):
+        label = rng.randrange(60)
+
+        def op(ws, label=label, dates=random_dates(rng)):
+            ws.touch([label])
+            ws.df.at[label, "available_dates"] = dates
+        queue.submit(op)
+    # 新使用者會擴充共用陣列
+    queue.submit(lambda ws: ws.append([{"user_id": "new", "available_dates": str(TODAY)}]))
+    done.set()
+    for reader in readers:
+        reader.join()
+    assert errors == []
+    assert match_scores(index, users + ["new"]) == match_scores(build(store.get_typed()), users + ["new"])
+
+# 查詢與差異更新共用同一把鎖：寫入者持有鎖時讀取端必須等待
+def test_top_matches_waits_for_writer_lock(stores):
+    index = stores["records"].get_index("matches", build, typed=True)
+    results = []
+    with index.lock:
+        reader = threading.Thread(target=lambda: results.append(index.top_matches("u0")))
+        reader.start()
+        reader.join(0.2)
+        assert results == []
+    reader.join()
+    assert len(results) == 1
+
+# 背景建立的索引在資料版本沒變時放進快取，之後直接取用
+def test_warm_index_is_cached(stores):
+    store = stores["records"]
+    warmed = store.warm_index("matches", build, typed=True)
+    assert warmed is not None
+    assert store.get_index("matches", build, typed=True) is warmed
+
+def cell(value):
+    return tuple(value) if isinstance(value, list) else ("NA" if pd.isna(value) else value)
+
+# 寫入後逐格轉換的列與整表的型別化檢視值相同（包含無法解析的日期與空白計數）
+def test_typed_rows_match_to_typed():
+    events = pd.DataFrame([
+        {"activity_id": "a0", "group_name": "g", "event_date": "2026-10-20", "participants_yes": "u1,u2", "yes_count": "2"},
+        {"activity_id": "a1", "group_name": "g", "event_date": "bad", "participants_yes": "", "yes_count": ""},
+        {"activity_id": "a2", "group_name": "h", "event_date": "", "participants_no": "u3", "no_count": 1},
+    ]).reindex(columns=EVENT_COLUMNS).fillna("")
+    full, rows = to_typed(events), to_typed_rows(events)
+    for col in EVENT_COLUMNS:
+        assert [cell(v) for v in full[col].astype(object)] == [cell(v) for v in rows[col]]
+
+# 以型別化檢視建立的活動索引，差異更新後與重新建立的結果一致
+def test_patched_event_index_matches_rebuild():
+    stores = make_stores()
+    store = stores["events"]
+    rng = random.Random(5)
+    store.save_df(pd.DataFrame([
+        {"activity_id": f"a{i}", "group_name": f"g{i % 3}", "event_date": str(TODAY + timedelta(days=i))} for i in range(10)
+    ]).reindex(columns=EVENT_COLUMNS).fillna(""))
+    index = store.get_index("events", EventIndex, typed=True)
+    queue = MutationQueue(stores, window=0)
+    for step in range(40):
+        def op(ws, step=step):
+            k = rng.random()
+            if k < 0.4 and len(ws.events):
+                label = rng.choice(list(ws.events.index))
+                ws.touch([label], table="events")
+                ws.events.at[label, "participants_yes"] = ",".join(rng.sample(["u1", "u2", "u3"], 2))
+                ws.events.at[label, "yes_count"] = 2
+            elif k < 0.8:
+                ws.append([{"activity_id": f"n{step}", "group_name": "g0", "event_date": str(TODAY)}], table="events")
+            elif len(ws.events):
+                ws.drop([rng.choice(list(ws.events.index))], table="events")
+        queue.submit(op)
+    assert store.get_index("events", EventIndex, typed=True) is index
+    rebuilt = EventIndex(store.get_typed())
+    assert {a: {c: cell(v) for c, v in row.items()} for a, row in index.rows.items()} == \
+        {a: {c: cell(v) for c, v in row.items()} for a, row in rebuilt.rows.items()}
+    assert index.labels == rebuilt.labels
+
+def wait_for(condition, timeout=10):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+# 讀取端不在資料表的 lock 內建立配對索引：沒有快取時先回傳 None 交給背景執行緒，
+# 建立期間其他讀取照常進行，完成後直接取用
+def test_match_index_builds_in_background(stores, monkeypatch):
+    monkeypatch.setattr(storage_module, "_stores", stores)
+    release = threading.Event()
+
+    def slow_build(*args, **kwargs):
+        release.wait(5)
+        return MatchIndex(*args, **kwargs)
+    monkeypatch.setattr(index_module, "MatchIndex", slow_build)
+    assert index_module.get_match_index() is None
+    started = time.perf_counter()
+    stores["records"].get_df()
+    stores["records"].get_row("user_id", "u1")
+    assert time.perf_counter() - started < 1
+    release.set()
+    assert wait_for(lambda: isinstance(index_module.get_match_index(), MatchIndex))
+    assert wait_for(lambda: not index_module._warm_lock.locked())
+
+# 換日後今天的索引還沒建好時，先沿用前一天的索引
+def test_match_index_falls_back_to_previous_day(stores, monkeypatch):
+    monkeypatch.setattr(storage_module, "_stores", stores)
+    monkeypatch.setattr(index_module, "request_warm", lambda: None)
+    yesterday = MatchIndex(stores["records"].get_typed(), TODAY - timedelta(days=1))
+    store = stores["records"]
+    store.indexes[index_module.match_index_name(TODAY - timedelta(days=1))] = (store.generation, yesterday, True)
+    assert index_module.get_match_index() is yesterday
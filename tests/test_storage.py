@@ -0,0 +1,191 @@
+import random
+import pandas as pd
+import pytest
+
+import storage_module
+from storage_module import DatasetStore, MutationQueue, Workspace, StorageBackend, TABLES, SAVE_ORDER, DEFAULT_COLUMNS, create_backends
+from index_module import FriendGraph, GroupIndex
+
+
+def make_stores():
+    backends = create_backends("memory")
+    return {table: DatasetStore(backend, TABLES[table]["columns"]) for table, backend in backends.items()}
+
+def user_rows(n):
+    rows = [{"user_id": f"u{i}", "password": "pass123"} for i in range(n)]
+    return pd.DataFrame(rows).reindex(columns=DEFAULT_COLUMNS).fillna("")
+
+def sheet_values(store):
+    return store.backend.sheet.get_all_values()
+
+@pytest.fixture
+def stores():
+    stores = make_stores()
+    stores["records"].save_df(user_rows(20))
+    return stores
+
+
+def random_op(rng, step):
+    def op(ws):
+        df = ws.df
+        k = rng.random()
+        if k < 0.4 and len(df):
+            label = rng.choice(list(df.index))
+            ws.touch([label])
+            df.at[label, "friends"] = ",".join(sorted(rng.sample("abcdef", 3)))
+        elif k < 0.6 and len(df):
+            label = rng.choice(list(df.index))
+            ws.touch([label])
+            df.at[label, "available_dates"] = [f"2026-10-{rng.randrange(10, 30)}"]
+        elif k < 0.9:
+            ws.append([{"user_id": f"n{step}"}])
+        elif len(df):
+            ws.drop(rng.sample(list(df.index), min(len(df), rng.randrange(1, 3))))
+    return op
+
+# 只比對標記過的列，寫出的試算表內容必須與整表比對完全相同
+def test_touched_rows_match_full_diff(stores):
+    reference = make_stores()
+    reference["records"].save_df(user_rows(20))
+    rng = random.Random(0)
+    for step in range(200):
+        ws = Workspace(stores)
+        for _ in range(rng.randrange(1, 4)):
+            ws.run(random_op(rng, step))
+        stores["records"].save_df(ws.frames["records"], ws.touched_rows("records"))
+        reference["records"].save_df(ws.frames["records"].copy())
+        assert sheet_values(stores["records"]) == sheet_values(reference["records"])
+        assert stores["records"].df.values.tolist() == reference["records"].df.values.tolist()
+
+# 工作區的修改在寫回前不能影響快取（否則寫回時比對不出差異，修改只留在快取）
+def test_workspace_edits_do_not_leak_into_cache(stores):
+    ws = Workspace(stores)
+    ws.df.at[0, "friends"] = "u1"
+    assert stores["records"].df.at[0, "friends"] == ""
+    stores["records"].save_df(ws.frames["records"], {0})
+    assert stores["records"].backend.read_records()[0]["friends"] == "u1"
+
+# 同一批次中有操作沒有標記列時，該資料表改為整表比對，不會漏寫
+def test_untracked_op_falls_back_to_full_diff(stores):
+    ws = Workspace(stores)
+
+    def tracked(ws):
+        ws.touch([0])
+        ws.df.at[0, "friends"] = "u1"
+
+    def untracked(ws):
+        ws.df.at[5, "friends"] = "u6"
+
+    ws.run(tracked)
+    ws.run(untracked)
+    assert ws.touched_rows("records") is None
+    stores["records"].save_df(ws.frames["records"], ws.touched_rows("records"))
+    rows = {r["user_id"]: r for r in stores["records"].backend.read_records()}
+    assert rows["u0"]["friends"] == "u1"
+    assert rows["u5"]["friends"] == "u6"
+
+# 以差異更新的索引與重新建立的索引一致
+def test_patched_indexes_match_rebuild(stores):
+    store = stores["records"]
+    store.get_index("groups", GroupIndex, typed=True)
+    store.get_index("friends", FriendGraph, typed=True)
+    queue = MutationQueue(stores, window=0)
+    rng = random.Random(1)
+    for _ in range(50):
+        a, b = rng.sample(range(20), 2)
+
+        def op(ws, a=a, b=b):
+            ws.touch([a, b])
+            ws.df.at[a, "friends"] = f"u{b}"
+            ws.df.at[b, "friends"] = f"u{a}"
+            ws.df.at[a, "groups"] = f"g{b % 3}"
+        queue.submit(op)
+    patched_groups = store.get_index("groups", GroupIndex, typed=True)
+    patched_friends = store.get_index("friends", FriendGraph, typed=True)
+    df = store.get_typed()
+    rebuilt_groups = GroupIndex(df)
+    rebuilt_friends = FriendGraph(df)
+    assert {g: set(m) for g, m in patched_groups.members.items()} == {g: set(m) for g, m in rebuilt_groups.members.items()}
+    for i in range(20):
+        assert patched_friends.friends_of(f"u{i}") == rebuilt_friends.friends_of(f"u{i}")
+
+# 把 u3 從使用者表搬到活動表，一次動到兩個資料表
+def move_user_to_events(ws):
+    ws.append([{"activity_id": "a3", "created_by": ws.df.at[3, "user_id"]}], table="events")
+    ws.drop([3])
+
+def table_records(stores):
+    return {name: store.backend.read_records() for name, store in stores.items()}
+
+# 同一批次先寫入接收資料的一方（歸檔表→活動表→使用者表）
+def test_batch_saves_in_dependency_order(stores, monkeypatch):
+    order = []
+    for name, store in stores.items():
+        write_rows = store.backend.write_rows
+
+        def recorded(snapshot, df, positions, name=name, write_rows=write_rows):
+            order.append(name)
+            return write_rows(snapshot, df, positions)
+        monkeypatch.setattr(store.backend, "write_rows", recorded)
+    MutationQueue(stores, window=0).submit(move_user_to_events)
+    assert order == [name for name in SAVE_ORDER if name in order] == ["events", "records"]
+
+# 後寫入的資料表失敗時，先寫入的資料表還原成原本的內容，兩邊都不會少資料
+def test_failed_second_write_restores_first(stores, monkeypatch):
+    before = table_records(stores)
+
+    def fail(*args):
+        raise RuntimeError("quota exceeded")
+    monkeypatch.setattr(stores["records"].backend, "write_rows", fail)
+    monkeypatch.setattr(stores["records"].backend, "write_changes", fail)
+    with pytest.raises(RuntimeError):
+        MutationQueue(stores, window=0).submit(move_user_to_events)
+    assert table_records(stores) == before
+    assert stores["events"].get_df(latest=True).empty
+    assert "u3" in stores["records"].get_df(latest=True)["user_id"].tolist()
+
+# 快取過期時單列查詢只比對版本標記；資料沒變就直接由快取回答，變了才整表重讀一次
+def test_get_row_answers_from_cache(stores, monkeypatch):
+    store = stores["records"]
+    reads = []
+    read_records = store.backend.read_records
+    monkeypatch.setattr(store.backend, "read_records", lambda: reads.append(1) or read_records())
+    store.checked_at = 0
+    assert store.get_row("user_id", "u3")["user_id"] == "u3"
+    assert store.get_row("user_id", "missing") is None
+    assert reads == []
+    other = DatasetStore(store.backend, TABLES["records"]["columns"])
+    other.save_df(user_rows(5))
+    reads.clear()
+    store.checked_at = 0
+    assert store.get_row("user_id", "u10") is None
+    assert reads == [1]
+
+# 閒置時的版本檢查一次讀出所有版本標記，不再逐表讀取；版本變了的資料表照常重新載入
+def test_versions_read_in_one_call(stores, monkeypatch):
+    monkeypatch.setattr(storage_module, "_stores", stores)
+    stores["events"].save_df(pd.DataFrame(columns=TABLES["events"]["columns"]))
+    calls = []
+    for store in stores.values():
+        monkeypatch.setattr(store.backend, "read_version", lambda: calls.append("cell"))
+        read_versions = store.backend.read_versions
+        monkeypatch.setattr(store.backend, "read_versions", lambda read=read_versions: calls.append("range") or read())
+        store.checked_at = 0
+    expected = (stores["records"].version, stores["events"].version)
+    assert storage_module.get_versions(("records", "events")) == expected
+    assert storage_module.get_versions(("records", "events")) == expected
+    assert calls == ["range"]
+    other = DatasetStore(stores["records"].backend, TABLES["records"]["columns"])
+    other.save_df(user_rows(5))
+    stores["records"].checked_at = 0
+    assert storage_module.get_versions(("records", "events")) == (other.version, expected[1])
+    assert len(stores["records"].get_df()) == 5
+
+# 缺少介面方法的後端在建立時就失敗，而不是寫到一半
+def test_incomplete_backend_fails_on_creation():
+    class ReadOnlyBackend(StorageBackend):
+        def read_records(self):
+            return []
+
+    with pytest.raises(TypeError):
+        ReadOnlyBackend()